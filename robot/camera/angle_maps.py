@@ -0,0 +1,98 @@
+"""
+Per-pixel angle lookup tables for the light ring cam, built from the lens
+calibration written by calibrate.py. Looking an angle up is one array index,
+and unlike the linear field of view formula it accounts for lens distortion.
+
+The tables for each resolution are cached in calibration/ next to the
+calibration itself.
+"""
+
+import math
+import os.path
+
+import cv2
+import numpy as np
+
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration')
+CALIBRATION = os.path.join(CALIBRATION_DIR, 'lifecam.npz')
+
+# resolutions calibrate.py builds tables for up front
+RESOLUTIONS = ((160, 120), (320, 240), (640, 480))
+
+
+def cache_path(size):
+    return os.path.join(CALIBRATION_DIR, 'angles_%dx%d.npy' % size)
+
+
+def load_calibration(size, calibration=CALIBRATION):
+    """
+    :param size: (width, height) in camera pixels
+    :return: (camera matrix, distortion) scaled to `size`, or None if the
+             camera was never calibrated
+    """
+    if not os.path.exists(calibration):
+        return None
+
+    with np.load(calibration) as data:
+        matrix = np.array(data['matrix'], dtype=np.float64)
+        matrix[:2] *= size[0] / float(data['size'][0])
+        return matrix, np.array(data['dist'], dtype=np.float64)
+
+
+def compute_maps(matrix, dist, calibrated_size, size):
+    """
+    :param matrix: camera matrix at `calibrated_size`
+    :param dist: distortion coefficients
+    :param size: (width, height) to build the tables for
+    :return: float32 array of (angle, height) maps in degrees, shape
+             (2, height, width), indexed by pixel row and column
+    """
+    w, h = size
+    scale = w / float(calibrated_size[0])
+
+    # the camera matrix scales with the resolution, distortion doesn't
+    matrix = np.array(matrix, dtype=np.float64)
+    matrix[:2] *= scale
+
+    # centers of all pixels
+    xs, ys = np.meshgrid(np.arange(w) + 0.5, np.arange(h) + 0.5)
+    points = np.stack((xs.ravel(), ys.ravel()), axis=-1).reshape(-1, 1, 2)
+
+    # normalized image coordinates are the tangents of the angles
+    normalized = cv2.undistortPoints(points, matrix, dist).reshape(h, w, 2)
+
+    return np.degrees(np.arctan(normalized)).transpose(2, 0, 1).astype(np.float32)
+
+
+def load_maps(size, calibration=CALIBRATION):
+    """
+    :param size: (width, height) in camera pixels
+    :return: maps as from :func:`compute_maps`, or None if the camera was
+             never calibrated
+    """
+    path = cache_path(size)
+    if os.path.exists(path):
+        return np.load(path)
+
+    if not os.path.exists(calibration):
+        return None
+
+    with np.load(calibration) as data:
+        maps = compute_maps(data['matrix'], data['dist'], tuple(data['size']), size)
+
+    try:
+        np.save(path, maps)
+    except OSError:
+        pass
+
+    return maps
+
+
+def lookup(maps, x, y):
+    """
+    :return: (angle, height) in degrees of the point (x, y)
+    """
+    h, w = maps.shape[1:]
+    col = min(max(int(math.floor(x)), 0), w - 1)
+    row = min(max(int(math.floor(y)), 0), h - 1)
+    return float(maps[0, row, col]), float(maps[1, row, col])
@@ -0,0 +1,94 @@
+"""
+Runs both detection backends of ImageProcessor over the same frames and
+compares their speed and the target record they publish.
+
+    python3 bench_detectors.py [image dir]
+"""
+
+import argparse
+import glob
+import os.path
+import timeit
+
+import cv2
+
+import target_record
+from image_processor import ImageProcessor
+
+DETECTORS = ('contours', 'components')
+
+# record field -> how far apart the backends may be
+COMPARED = (
+    (target_record.PRESENT, 0),
+    (target_record.PARTIAL, 0),
+    (target_record.ANGLE, 0.5),
+    (target_record.SKEW, 0.05),
+    (target_record.HEIGHT, 0.5),
+    (target_record.POSE, 0),
+    (target_record.DISTANCE, 0.1),
+    (target_record.LATERAL, 0.1),
+)
+
+NAMES = {target_record.PRESENT: 'present', target_record.PARTIAL: 'partial', target_record.ANGLE: 'angle',
+         target_record.SKEW: 'skew', target_record.HEIGHT: 'height', target_record.POSE: 'pose',
+         target_record.DISTANCE: 'distance', target_record.LATERAL: 'lateral'}
+
+
+def differences(a, b):
+    """
+    :return: list of the record fields that differ beyond their tolerance
+    """
+    return ['%s %.3f vs %.3f' % (NAMES[i], a[i], b[i]) for i, tolerance in COMPARED
+            if abs(a[i] - b[i]) > tolerance]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default='images')
+    parser.add_argument('--number', type=int, default=100)
+    args = parser.parse_args()
+
+    processor = ImageProcessor()
+
+    # every frame must go through full detection
+    processor.roi_enabled = False
+    processor.tracker_enabled = False
+    processor.motion_enabled = False
+    processor.refresh_config()
+
+    totals = dict.fromkeys(DETECTORS, 0)
+    frames = 0
+    mismatches = 0
+
+    for fname in sorted(glob.glob(os.path.join(args.path, '*.jpg'))):
+        img = cv2.resize(cv2.imread(fname), (320, 240))
+        frames += 1
+
+        results = {}
+        for detector in DETECTORS:
+            processor.detector = detector
+
+            # the NT listener updates the snapshot asynchronously, don't wait for it
+            processor.refresh_config()
+
+            # the pose solve starts from the last frame's, don't carry it over
+            processor.pose = None
+
+            processor.process_frame(img, 0)
+            results[detector] = list(processor.records['target'])
+
+            totals[detector] += timeit.timeit(lambda: processor.process_frame(img, 0), number=args.number)
+
+        diff = differences(*(results[detector] for detector in DETECTORS))
+        if diff:
+            mismatches += 1
+            print('%s: %s' % (fname, ', '.join(diff)))
+
+    for detector in DETECTORS:
+        print('%-10s %8.2f ms/frame' % (detector, 1e3 * totals[detector] / max(frames * args.number, 1)))
+
+    print('%d frames, %d with different targets' % (frames, mismatches))
+
+
+if __name__ == '__main__':
+    main()
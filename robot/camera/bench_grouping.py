@@ -0,0 +1,179 @@
+"""
+Compares the gear target grouping and selection in ImageProcessor against
+the original nested-loop implementation, both for speed and for which
+targets get picked, including the one the angle is measured from.
+
+    python3 bench_grouping.py [image dir] [--noise N]
+
+--noise adds N small fake contours to every frame to mimic a brightly lit
+venue.
+"""
+
+import argparse
+import glob
+import os.path
+import timeit
+
+import cv2
+import numpy as np
+
+from image_processor import ImageProcessor, make_features
+
+
+def get_contour_info(contour):
+    contour_info = {}
+
+    contour_info['x'], contour_info['y'], contour_info['w'], contour_info['h'] = cv2.boundingRect(contour)
+
+    contour_info['cx'] = contour_info['x'] + contour_info['w'] / 2
+    contour_info['cy'] = contour_info['y'] + contour_info['h'] / 2
+
+    return contour_info
+
+
+def legacy_group_targets(processor, contours):
+    # The original implementation, kept here as the reference
+    targets = []
+
+    for c in contours:
+        target_info = get_contour_info(c)
+        target_info['cnt'] = c
+
+        targets.append(target_info)
+
+    full_targets = []
+    for i, b in enumerate(targets[:]):
+        matched = False
+        for i2, b2 in enumerate(targets[i+1:]):
+            if b['cx'] >= b2['cx'] - processor.broken_tolerance_x and b['cx'] <= b2['cx'] + processor.broken_tolerance_x:
+                matched = True
+                new_blob = np.concatenate([b['cnt'], b2['cnt']])
+
+                hull = cv2.convexHull(new_blob)
+                new_blob = cv2.approxPolyDP(hull, 0.01*cv2.arcLength(hull, True), True)
+
+                target_info = get_contour_info(new_blob)
+                target_info['cnt'] = new_blob
+
+                full_targets.append(target_info)
+                targets.remove(b)
+
+                break
+        if not matched:
+            full_targets.append(b)
+
+    # the angle was measured from whatever target_info was left holding
+    return full_targets, target_info
+
+
+def legacy_select_targets(processor, full_targets):
+    full_targets = full_targets[:]
+    h = float(processor.size[0])
+
+    primary_target = None
+    for i, g in enumerate(full_targets[:]):
+        greater_than = True
+
+        for g2 in full_targets[i+1:]:
+            if g['cx'] - (h / 2) < g2['cx'] - (h / 2):
+                greater_than = False
+
+        if greater_than:
+            primary_target = g
+            full_targets.remove(g)
+            break
+
+    secondary_target = None
+    for i, g in enumerate(full_targets):
+        greater_than = True
+
+        if abs(g['cx'] - primary_target['cx']) < processor.gear_spacing * primary_target['h']:
+            for g2 in full_targets[i:]:
+                if g['cx'] - (h / 2) < g2['cx'] - (h / 2):
+                    greater_than = False
+        else:
+            greater_than = False
+
+        if greater_than:
+            secondary_target = g
+            break
+
+    return primary_target, secondary_target
+
+
+def noise_contours(n, size, rng):
+    h, w = size
+    result = []
+    for _ in range(n):
+        x = rng.randint(0, w - 6)
+        y = rng.randint(0, h - 6)
+        result.append(np.array([[[x, y]], [[x + 4, y]], [[x + 4, y + 4]], [[x, y + 4]]], dtype=np.int32))
+    return result
+
+
+def legacy_rect(info):
+    return (info['x'], info['y'], info['w'], info['h']) if info is not None else None
+
+
+def rect(targets, i):
+    return tuple(int(targets[name][i]) for name in ('x', 'y', 'w', 'h')) if i is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default='images')
+    parser.add_argument('--noise', type=int, default=0)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    processor = ImageProcessor()
+    rng = np.random.RandomState(1418)
+
+    totals = {'legacy group': 0, 'group': 0, 'legacy select': 0, 'select': 0}
+    mismatches = 0
+    frames = 0
+
+    for fname in sorted(glob.glob(os.path.join(args.path, '*.jpg'))):
+        img = cv2.resize(cv2.imread(fname), (320, 240))
+        processor.preallocate(img)
+
+        features, polygon = processor.find_contours(img)
+        contours = [polygon(i) for i in range(len(features))]
+        contours += noise_contours(args.noise, processor.size, rng)
+
+        boxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.float64).reshape(-1, 4)
+        features = make_features(boxes, [cv2.contourArea(c) for c in contours])
+
+        old, old_angle = legacy_group_targets(processor, contours)
+        groups, new = processor.group_targets(features)
+
+        totals['legacy group'] += timeit.timeit(lambda: legacy_group_targets(processor, contours), number=args.number)
+        totals['group'] += timeit.timeit(lambda: processor.group_targets(features), number=args.number)
+
+        frames += 1
+        if len(old) == 0 or len(new) == 0:
+            if len(old) != len(new):
+                mismatches += 1
+                print('%s: legacy found %d targets, new found %d' % (fname, len(old), len(new)))
+            continue
+
+        old_p, old_s = legacy_select_targets(processor, old)
+        p, s = processor.select_targets(new)
+
+        totals['legacy select'] += timeit.timeit(lambda: legacy_select_targets(processor, old), number=args.number)
+        totals['select'] += timeit.timeit(lambda: processor.select_targets(new), number=args.number)
+
+        expected = (legacy_rect(old_p), legacy_rect(old_s), legacy_rect(old_angle))
+        actual = (rect(new, p), rect(new, s), rect(new, processor.angle_target(groups)))
+        if expected != actual:
+            mismatches += 1
+            print('%s: legacy picked %s, new picked %s' % (fname, expected, actual))
+
+    for name in sorted(totals):
+        print('%-14s %8.1f us/frame' % (name, 1e6 * totals[name] / max(frames * args.number, 1)))
+
+    print('%d frames, %d mismatches' % (frames, mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Headless benchmark of ImageProcessor.process_frame. Runs a directory of
+images (or a video or a recording) through the processor at several resolutions and
+reports per-stage timings, frames per second and latency percentiles.
+
+    python3 benchmark.py [images or video] [-o report.json]
+    python3 benchmark.py --sizes 640x480 --strip-workers 1,2,4
+
+The JSON report is meant to be diffed between commits.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+
+import cv2
+import numpy as np
+
+from image_processor import ImageProcessor
+from replay import load_frames
+from stats import StageTimes
+
+
+def parse_size(size):
+    w, h = size.split('x')
+    return int(w), int(h)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(processor, frames, passes):
+    """
+    Processes every frame `passes` times.
+
+    :return: dict with the frame count, fps and per-stage summaries
+    """
+    processor.times = StageTimes(processor.STAGES, size=len(frames) * passes)
+
+    # first frame allocates buffers, keep it out of the numbers
+    processor.process_frame(frames[0], 0)
+    processor.times.reset()
+
+    n = 0
+    start = time.perf_counter()
+    for _ in range(passes):
+        for frame in frames:
+            n += 1
+            processor.process_frame(frame, n)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'frames': n,
+        'fps': n / elapsed,
+        'stages': {stage: processor.times.summary(stage) for stage in processor.STAGES},
+    }
+
+
+def check_strips(processor, frames, workers):
+    """
+    :return: number of frames whose closed threshold image differs between
+             one thread and `workers` strip workers
+    """
+    differ = 0
+
+    for frame in frames:
+        processor.preallocate(frame)
+
+        processor.strip_workers = 1
+        processor.refresh_config()
+        expected = processor.threshold(frame).copy()
+
+        processor.strip_workers = workers
+        processor.refresh_config()
+        differ += not np.array_equal(expected, processor.threshold(frame))
+
+    return differ
+
+
+def usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default='images')
+    parser.add_argument('--sizes', default='160x120,320x240,640x480',
+                        help='comma separated WxH resolutions to run at')
+    parser.add_argument('--passes', type=int, default=20, help='times to run over all frames')
+    parser.add_argument('--detector', choices=('contours', 'components'), default='contours')
+    parser.add_argument('--no-roi', action='store_true', help='run full detection on every frame')
+    parser.add_argument('--render', action='store_true', help='draw overlays like a watched stream')
+    parser.add_argument('--strip-workers', default='1',
+                        help='comma separated numbers of threshold strip workers to compare')
+    parser.add_argument('-o', '--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    frames = [frame for _, frame in load_frames(args.path)]
+    if not frames:
+        parser.error('no frames found in %s' % args.path)
+
+    report = {
+        'revision': git_revision(),
+        'source': args.path,
+        'detector': args.detector,
+        'roi': not args.no_roi,
+        'render': args.render,
+        'cpus': usable_cpus(),
+        'results': {},
+    }
+
+    if max(int(n) for n in args.strip_workers.split(',')) > report['cpus']:
+        print('Only %d usable cores, strip workers beyond that can only add overhead' % report['cpus'])
+
+    for size in args.sizes.split(','):
+        resized = [cv2.resize(f, parse_size(size)) for f in frames]
+        single_fps = None
+
+        for workers in [int(n) for n in args.strip_workers.split(',')]:
+            processor = ImageProcessor()
+            processor.render = args.render
+            processor.detector = args.detector
+            processor.roi_enabled = not args.no_roi
+
+            name = size if workers == 1 else '%s/%d' % (size, workers)
+
+            if workers > 1:
+                differ = check_strips(processor, resized, workers)
+            processor.strip_workers = workers
+            processor.refresh_config()
+
+            result = run(processor, resized, args.passes)
+            report['results'][name] = result
+
+            print('%s: %d frames, %.1f fps' % (name, result['frames'], result['fps']))
+            if workers == 1:
+                single_fps = result['fps']
+            else:
+                result['mismatches'] = differ
+                print('    %d strip workers: %d frames differ from one thread' % (workers, differ))
+                if single_fps:
+                    print('    %.2fx the speed of one thread' % (result['fps'] / single_fps))
+
+            for stage in processor.STAGES:
+                s = result['stages'][stage]
+                if s is not None:
+                    print('    %-11s mean %7.3f  p50 %7.3f  p95 %7.3f  p99 %7.3f ms' %
+                          (stage, s['mean'], s['p50'], s['p95'], s['p99']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
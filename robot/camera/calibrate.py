@@ -0,0 +1,87 @@
+"""
+Calibrates the light ring cam from photos of a checkerboard, and builds the
+angle lookup tables the vision process uses (see angle_maps.py).
+
+    python3 calibrate.py checkerboard/*.jpg [--pattern 9x6]
+
+Take 15-20 photos with the camera at its usual resolution, with the board
+at different angles and in all parts of the frame.
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+import angle_maps
+
+
+def parse_pattern(pattern):
+    cols, rows = pattern.split('x')
+    return int(cols), int(rows)
+
+
+def find_corners(fnames, pattern):
+    """
+    :return: (image size, list of corner arrays, one per usable image)
+    """
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+    size = None
+    corners = []
+
+    for fname in fnames:
+        gray = cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2GRAY)
+
+        if size is None:
+            size = gray.shape[::-1]
+        elif gray.shape[::-1] != size:
+            print('%s: skipped, not %dx%d' % (fname, size[0], size[1]))
+            continue
+
+        found, points = cv2.findChessboardCorners(gray, pattern, None)
+        if not found:
+            print('%s: no checkerboard found' % fname)
+            continue
+
+        corners.append(cv2.cornerSubPix(gray, points, (11, 11), (-1, -1), criteria))
+
+    return size, corners
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--pattern', default='9x6', help='inner corners of the board, columns x rows')
+    parser.add_argument('-o', '--output', default=angle_maps.CALIBRATION)
+    args = parser.parse_args()
+
+    pattern = parse_pattern(args.pattern)
+    size, corners = find_corners(args.images, pattern)
+
+    if len(corners) < 5:
+        parser.error('only %d usable images, need at least 5' % len(corners))
+
+    # the square size doesn't matter, only angles are wanted
+    board = np.zeros((pattern[0] * pattern[1], 3), np.float32)
+    board[:, :2] = np.mgrid[0:pattern[0], 0:pattern[1]].T.reshape(-1, 2)
+
+    error, matrix, dist, _, _ = cv2.calibrateCamera([board] * len(corners), corners, size, None, None)
+    print('Calibrated from %d images at %dx%d, reprojection error %.3f px' % (len(corners), size[0], size[1], error))
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    np.savez(args.output, matrix=matrix, dist=dist, size=np.array(size))
+
+    # old tables belong to the old calibration
+    for resolution in angle_maps.RESOLUTIONS:
+        path = angle_maps.cache_path(resolution)
+        if os.path.exists(path):
+            os.remove(path)
+
+        angle_maps.load_maps(resolution, args.output)
+        print('Wrote %s' % path)
+
+
+if __name__ == '__main__':
+    main()
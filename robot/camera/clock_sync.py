@@ -0,0 +1,146 @@
+"""
+Estimates the offset between the vision process clock and the robot clock
+over NetworkTables, so target timestamps can be given in robot time.
+
+The vision process puts [seq, sent] to /camera/clock/ping a few times a
+second, with `sent` from time.monotonic(). The robot answers each ping with
+[seq, sent, robot time] on /camera/clock/pong (see
+controllers/position_history.py). Assuming the reply was stamped halfway
+through the round trip, each pong gives one offset sample; the samples with
+the shortest round trips are the least delayed by NT, and a line fitted
+through them also tracks the drift between the two clocks.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from networktables import NetworkTable
+
+
+class ClockSync:
+
+    # pongs slower than this tell us nothing useful
+    MAX_RTT = 0.5
+
+    # an offset this far off the estimate means the robot clock jumped
+    MAX_JUMP = 1.0
+
+    # drift is only fitted once the best samples span this many seconds
+    MIN_DRIFT_SPAN = 5.0
+
+    def __init__(self, interval=0.25, samples=64, best=8):
+        """
+        :param interval: seconds between pings
+        :param samples: number of offset samples kept
+        :param best: number of shortest round trip samples used
+        """
+        self.interval = interval
+        self.best = best
+
+        self.mids = np.zeros(samples)
+        self.offsets = np.zeros(samples)
+        self.rtts = np.zeros(samples)
+        self.count = 0
+
+        # (reference time, offset at reference, drift), replaced as a whole
+        # so readers on other threads never see half an update
+        self.estimate = None
+        self.rtt = None
+
+        # whether cscore stamps frames with the realtime or monotonic clock
+        self.realtime = None
+
+        self.seq = 0
+        self.nt = NetworkTable.getTable('/camera/clock')
+        self.nt.addTableListener(self._on_pong, False, 'pong')
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.seq += 1
+            self.nt.putNumberArray('ping', [self.seq, time.monotonic()])
+            NetworkTable.flush()
+
+            time.sleep(self.interval)
+
+    def _on_pong(self, source, key, value, isNew):
+        received = time.monotonic()
+
+        if len(value) < 3:
+            return
+
+        seq, sent, robot = value[:3]
+        rtt = received - sent
+
+        if seq > self.seq or not 0 <= rtt < self.MAX_RTT:
+            return
+
+        mid = (sent + received) / 2.0
+        offset = robot - mid
+
+        estimate = self.estimate
+        if estimate is not None and abs(self._offset_at(estimate, mid) - offset) > self.MAX_JUMP:
+            # the robot code restarted with a new clock, start over
+            self.count = 0
+
+        i = self.count % len(self.mids)
+        self.mids[i] = mid
+        self.offsets[i] = offset
+        self.rtts[i] = rtt
+        self.count += 1
+
+        self._update()
+
+    def _update(self):
+        n = min(self.count, len(self.mids))
+        best = np.argsort(self.rtts[:n])[:self.best]
+
+        mids = self.mids[best]
+        offsets = self.offsets[best]
+
+        ref = mids.max()
+        if mids.max() - mids.min() >= self.MIN_DRIFT_SPAN:
+            drift, offset = np.polyfit(mids - ref, offsets, 1)
+        else:
+            drift, offset = 0.0, offsets[0]
+
+        self.rtt = float(self.rtts[best[0]])
+        self.estimate = (ref, float(offset), float(drift))
+
+    @staticmethod
+    def _offset_at(estimate, t):
+        ref, offset, drift = estimate
+        return offset + drift * (t - ref)
+
+    @property
+    def synced(self):
+        return self.estimate is not None
+
+    def from_frame(self, ts):
+        """
+        :param ts: cscore frame timestamp, in microseconds
+        :return: the same time in seconds on the time.monotonic() clock
+        """
+        t = ts / 1e6
+
+        if self.realtime is None and t > 0:
+            self.realtime = abs(t - time.time()) < abs(t - time.monotonic())
+
+        if self.realtime:
+            return t - (time.time() - time.monotonic())
+        return t
+
+    def to_robot(self, t):
+        """
+        :param t: time.monotonic() time in this process
+        :return: (robot time, True), or (t, False) before the first pong
+        """
+        estimate = self.estimate
+        if estimate is None:
+            return t, False
+
+        return t + self._offset_at(estimate, t), True
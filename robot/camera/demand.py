@@ -0,0 +1,12 @@
+"""
+Levels the robot code can ask the vision process for, through
+/camera/control/vision_demand. The vision process runs as fast as the
+demand needs and no faster.
+
+This module is shared by the vision process and the robot code, so it must
+not import anything.
+"""
+
+OFF = 0  # nobody needs targets, camera on auto exposure for the driver
+PRESENCE = 1  # only whether a target is there, at a low keep-alive rate on auto exposure
+ALIGN = 2  # actively aligning, every frame
@@ -0,0 +1,94 @@
+import threading
+
+import numpy as np
+
+
+class LatestFrame:
+    """
+    Single-slot handoff between two pipeline stages.
+
+    The producer always overwrites the slot with its newest frame, so the
+    consumer never works on anything older than one processing interval. A
+    frame that gets replaced before the consumer took it is counted as
+    dropped and its buffer goes back to the pool for reuse.
+
+    Buffers are preallocated and passed around by reference; nothing is
+    copied or allocated per frame.
+
+    With `lossless` set the producer waits for the consumer instead of
+    dropping frames, for replaying recordings as fast as possible.
+    """
+
+    def __init__(self, shape, dtype, buffers=3, lossless=False):
+        self.cond = threading.Condition()
+        self.lossless = lossless
+
+        # one for the producer, one in the slot, one for the consumer
+        self.free = [np.zeros(shape, dtype=dtype) for _ in range(buffers)]
+
+        self.slot = None
+        self.closed = False
+        self.dropped = 0
+        self.published = 0
+
+    def acquire(self):
+        """
+        :return: A buffer the producer may write the next frame into
+        """
+        with self.cond:
+            return self.free.pop()
+
+    def publish(self, buf, ts):
+        """
+        Makes `buf` the newest frame, dropping any frame nobody took yet.
+        """
+        with self.cond:
+            if self.lossless:
+                while self.slot is not None:
+                    self.cond.wait()
+
+            if self.slot is not None:
+                self.free.append(self.slot[0])
+                self.dropped += 1
+
+            self.slot = (buf, ts)
+            self.published += 1
+            self.cond.notify_all()
+
+    def take(self, timeout=None):
+        """
+        Waits for a frame. The consumer must hand the buffer back with
+        :meth:`release` once it is done with it.
+
+        :return: (buffer, timestamp), or None if the timeout expired or
+                 the producer closed the handoff
+        """
+        with self.cond:
+            if self.slot is None and not self.closed:
+                self.cond.wait(timeout)
+
+            item = self.slot
+            self.slot = None
+            self.cond.notify_all()
+            return item
+
+    def release(self, buf):
+        with self.cond:
+            self.free.append(buf)
+
+    def discard(self):
+        """
+        Drops the pending frame, if any, without counting it.
+        """
+        with self.cond:
+            if self.slot is not None:
+                self.free.append(self.slot[0])
+                self.slot = None
+
+    def close(self):
+        """
+        Called by the producer when no more frames will come.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
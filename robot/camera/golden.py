@@ -0,0 +1,206 @@
+"""
+Golden images for the gear target detector: the target ImageProcessor is
+expected to find in each of the images, and how long it used to take.
+
+    python3 golden.py --update    # label the images with what is found now
+    python3 golden.py             # compare what is found now with the labels
+
+Labels written by --update must be checked by hand before committing them.
+tests/test_vision_golden.py runs the same comparison under pytest, for
+every detection backend.
+
+images/golden.json looks like:
+
+    {
+        "baseline_ms": 1.8,
+        "frames": [
+            {"image": "GearTarget.jpg", "present": true, "partial": false,
+             "angle": -3.2, "skew": 0.05, "distance": 2.6, "lateral": 0.2,
+             "tolerance": {"angle": 0.5, "skew": 0.05, "distance": 0.1, "lateral": 0.1}},
+            ...
+        ]
+    }
+
+distance and lateral are the solved peg pose in feet. A value of null isn't
+checked, e.g. the skew of a target that is partly hidden behind the peg.
+"""
+
+import argparse
+import json
+import os.path
+
+import cv2
+
+import target_record
+from image_processor import ImageProcessor
+from stats import StageTimes
+
+IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+LABELS = os.path.join(IMAGES, 'golden.json')
+
+# frames are processed at the camera resolution
+SIZE = (320, 240)
+
+DEFAULT_TOLERANCE = {'angle': 0.5, 'skew': 0.05, 'distance': 0.1, 'lateral': 0.1}
+
+# the published record is compared on these, besides present and partial
+MEASURED = ('angle', 'skew', 'distance', 'lateral')
+
+DETECTORS = ('contours', 'components')
+
+# how many times slower than the baseline before the suite warns. The
+# baseline is from whatever machine ran --update, so this is only a hint.
+TIME_BUDGET = 1.5
+
+
+def load_labels(path=LABELS):
+    """
+    :return: the label file contents, or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def load_image(name, images=IMAGES):
+    """
+    :param images: directory the label's image names are relative to
+    """
+    return cv2.resize(cv2.imread(os.path.join(images, name)), SIZE)
+
+
+def make_processor(detector='contours'):
+    """
+    :param detector: detection backend, one of DETECTORS
+    :return: an ImageProcessor that runs full detection on every frame
+    """
+    processor = ImageProcessor()
+    processor.render = False
+    processor.detector = detector
+    processor.roi_enabled = False
+    processor.tracker_enabled = False
+    processor.motion_enabled = False
+
+    # the assignments above only reach the processor's snapshot once it's refreshed
+    processor.refresh_config()
+    return processor
+
+
+def detect(processor, img):
+    """
+    :return: the target found in `img`, in the same form as a label
+    """
+    # every image is solved from scratch, not from the last one's pose
+    processor.pose = None
+
+    processor.process_frame(img, 0)
+    record = processor.records['target']
+    pose = bool(record[target_record.POSE])
+
+    return {
+        'present': bool(record[target_record.PRESENT]),
+        'partial': bool(record[target_record.PARTIAL]),
+        'angle': record[target_record.ANGLE],
+        'skew': record[target_record.SKEW],
+        'distance': record[target_record.DISTANCE] if pose else None,
+        'lateral': record[target_record.LATERAL] if pose else None,
+    }
+
+
+def compare(label, found):
+    """
+    :return: list of differences beyond the label's tolerance
+    """
+    errors = []
+
+    for key in ('present', 'partial'):
+        if found[key] != label[key]:
+            errors.append('%s is %s, expected %s' % (key, found[key], label[key]))
+
+    if label['present'] and found['present']:
+        tolerance = dict(DEFAULT_TOLERANCE, **label.get('tolerance', {}))
+        for key in MEASURED:
+            # null where the image doesn't show a meaningful value
+            if label.get(key) is None:
+                continue
+            if found[key] is None:
+                errors.append('no %s, expected %.3f' % (key, label[key]))
+            elif abs(found[key] - label[key]) > tolerance[key]:
+                errors.append('%s is %.3f, expected %.3f' % (key, found[key], label[key]))
+
+    return errors
+
+
+def median_ms(processor, images, passes=20):
+    """
+    :return: median time of a whole process_frame call, in milliseconds
+    """
+    processor.times = StageTimes(processor.STAGES, size=len(images) * passes)
+
+    # the first frame allocates buffers
+    processor.process_frame(images[0], 0)
+    processor.times.reset()
+
+    for _ in range(passes):
+        for img in images:
+            processor.process_frame(img, 0)
+
+    return processor.times.summary('total')['p50']
+
+
+def update(path=LABELS):
+    processor = make_processor()
+
+    names = sorted(f for f in os.listdir(IMAGES) if f.endswith('.jpg'))
+    frames = []
+    for name in names:
+        found = detect(processor, load_image(name))
+        label = dict(image=name, tolerance=DEFAULT_TOLERANCE, present=found['present'], partial=found['partial'])
+        for key in MEASURED:
+            label[key] = None if found[key] is None else round(found[key], 3)
+        frames.append(label)
+
+    baseline = median_ms(processor, [load_image(name) for name in names])
+
+    with open(path, 'w') as fp:
+        json.dump({'baseline_ms': round(baseline, 3), 'frames': frames}, fp, indent=4, sort_keys=True)
+
+    print('Labelled %d images, baseline %.2f ms/frame' % (len(frames), baseline))
+
+
+def check(labels):
+    for detector in DETECTORS:
+        processor = make_processor(detector)
+        failures = 0
+
+        for label in labels['frames']:
+            errors = compare(label, detect(processor, load_image(label['image'])))
+            if errors:
+                failures += 1
+                print('%s %s: %s' % (detector, label['image'], ', '.join(errors)))
+
+        ms = median_ms(processor, [load_image(label['image']) for label in labels['frames']])
+        print('%s: %d of %d images differ, %.2f ms/frame (baseline %.2f)' %
+              (detector, failures, len(labels['frames']), ms, labels['baseline_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true', help='relabel the images from the current detector')
+    args = parser.parse_args()
+
+    if args.update:
+        update()
+        return
+
+    labels = load_labels()
+    if labels is None:
+        parser.error('no labels, run with --update first')
+
+    check(labels)
+
+
+if __name__ == '__main__':
+    main()
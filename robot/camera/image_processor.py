@@ -1,10 +1,54 @@
 import cv2
+import json
 import numpy as np
 import math
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 from networktables import NetworkTable
 from networktables.util import ntproperty
 
+import angle_maps
+import target_record
+from stats import StageTimes
+from tracker import AlphaBetaTracker
+
+# One row per candidate blob or target, in frame pixels
+FEATURES = np.dtype([('x', 'f8'), ('y', 'f8'), ('w', 'f8'), ('h', 'f8'),
+                     ('cx', 'f8'), ('cy', 'f8'), ('area', 'f8'), ('aspect', 'f8')])
+
+
+
+def _tape_corners(left):
+    # clockwise from the top left, inches, y down
+    return [(left, -2.5, 0), (left + 2, -2.5, 0), (left + 2, 2.5, 0), (left, 2.5, 0)]
+
+
+# The gear peg tapes are 2" x 5" with their outer edges 10.25" apart. Corners
+# of the left then the right tape, in feet, with the peg at the origin.
+PEG_MODEL = np.array(_tape_corners(-5.125) + _tape_corners(3.125), dtype=np.float64) / 12.0
+
+
+def make_features(boxes, area):
+    """
+    :param boxes: array of x, y, w, h rows
+    :param area: area of each box's blob
+    :return: FEATURES array with the derived columns filled in
+    """
+    features = np.empty(len(boxes), dtype=FEATURES)
+
+    for i, name in enumerate(('x', 'y', 'w', 'h')):
+        features[name] = boxes[:, i]
+
+    features['cx'] = features['x'] + features['w'] / 2
+    features['cy'] = features['y'] + features['h'] / 2
+    features['area'] = area
+    features['aspect'] = features['w'] / np.maximum(features['h'], 1)
+
+    return features
+
 
 class ImageProcessor:
     # Values for the lifecam-3000
@@ -32,6 +76,14 @@ class ImageProcessor:
 
     gear_spacing = ntproperty('/camera/processor/gear_spacing', 2)
 
+    # 'contours' (findContours + approxPolyDP) or 'components' (connectedComponentsWithStats)
+    detector = ntproperty('/camera/processor/detector', 'contours')
+
+    # Threshold and close horizontal strips of the frame on this many threads.
+    # Needs spare cores: on a single core 2 and 4 workers measured slower
+    # than 1, see benchmark.py --strip-workers
+    strip_workers = ntproperty('/camera/processor/strip_workers', 1)
+
     draw_thresh = ntproperty('/camera/processor/draw_thresh', True)
     draw_approx = ntproperty('/camera/processor/draw_approx', False)
     draw_approx2 = ntproperty('/camera/processor/draw_approx2', False)
@@ -39,13 +91,175 @@ class ImageProcessor:
     draw_gear_patch = ntproperty('/camera/processor/draw_gear_patch', False)
     draw_gear_target = ntproperty('/camera/processor/draw_gear_target', True)
 
-    def __init__(self):
+    # Once a target is found, only search a window around it
+    roi_enabled = ntproperty('/camera/processor/roi/enabled', True)
+    roi_padding = ntproperty('/camera/processor/roi/padding', 0.5)  # in target heights
+    roi_full_interval = ntproperty('/camera/processor/roi/full_interval', 10)  # frames
+
+    # Predict the target in between full detections
+    tracker_enabled = ntproperty('/camera/processor/tracker/enabled', False)
+    tracker_interval = ntproperty('/camera/processor/tracker/detect_interval', 3)  # frames
+    tracker_min_confidence = ntproperty('/camera/processor/tracker/min_confidence', 0.5)
+
+    # Also look for the boiler tape in the same candidates. Needs the whole
+    # frame every time, so the ROI and tracker are off while this is on.
+    boiler_enabled = ntproperty('/camera/processor/boiler/enabled', False)
+    boiler_min_aspect = ntproperty('/camera/processor/boiler/min_aspect', 1.5)  # width / height
+    boiler_spacing = ntproperty('/camera/processor/boiler/spacing', 3)  # in top strip heights
+    draw_boiler_target = ntproperty('/camera/processor/draw_boiler_target', True)
+
+    # Republish the last result instead of processing a frame that looks
+    # the same as the last processed one
+    motion_enabled = ntproperty('/camera/processor/motion/enabled', False)
+    motion_threshold = ntproperty('/camera/processor/motion/threshold', 2.0)  # mean abs difference
+    motion_max_skip = ntproperty('/camera/processor/motion/max_skip', 20)  # frames
+
+    # Read from NT once per frame (and only when something changed), never
+    # from inside the per-contour loops
+    CONFIG = (
+        'min_width', 'min_height',
+        'thresh_hue_lower', 'thresh_hue_high',
+        'thresh_sat_lower', 'thresh_sat_high',
+        'thresh_val_lower', 'thresh_val_high',
+        'broken_tolerance_x', 'gear_spacing',
+        'draw_thresh', 'draw_approx', 'draw_approx2', 'draw_gear_patch', 'draw_gear_target',
+        'draw_boiler_target',
+        'roi_enabled', 'roi_padding', 'roi_full_interval',
+        'tracker_enabled', 'tracker_interval', 'tracker_min_confidence',
+        'boiler_enabled', 'boiler_min_aspect', 'boiler_spacing',
+        'motion_enabled', 'motion_threshold', 'motion_max_skip',
+        'detector', 'strip_workers',
+    )
+
+    # Rows each strip reads beyond its own for the closing, more than the
+    # kernel reaches
+    STRIP_OVERLAP = 4
+
+    STAGES = ('motion', 'threshold', 'morphology', 'contours', 'grouping', 'pose', 'boiler', 'publish', 'total')
+
+    # The motion gate compares frames shrunk by this much
+    MOTION_SCALE = 8
+
+    def __init__(self, decode_scale=1):
+        """
+        :param decode_scale: how many times smaller than the camera
+                             resolution the frames will be
+        """
         self.size = None
-        self.thresh_low = np.array([self.thresh_hue_lower, self.thresh_sat_lower, self.thresh_val_lower], dtype=np.uint8)
-        self.thresh_high = np.array([self.thresh_hue_high, self.thresh_sat_high, self.thresh_val_high], dtype=np.uint8)
+
+        # How long each stage took over the last frames
+        self.times = StageTimes(self.STAGES)
+
+        # Overlays are only drawn when something will actually show them
+        self.render = True
+
+        # Frames are this many times smaller than the camera resolution.
+        # Settings in pixels and everything published are in camera pixels.
+        self.decode_scale = decode_scale
+
+        # Per-pixel angles from the lens calibration, or None to use the
+        # field of view
+        self.angle_lut = None
+
+        # Camera intrinsics for solvePnP, and the last solved (rvec, tvec)
+        # to start the next solve from
+        self.camera_matrix = None
+        self.dist_coeffs = None
+        self.pose = None
+
+        # (x0, y0, x1, y1) window to search next frame, or None for full frame
+        self.roi = None
+        self.roi_frames = 0
+
+        self.main_target_contour = None
+        self.main_target_partial = True
+
+        # cx, cy, h and skew of the last full target, or None
+        self.target_state = None
+        self.tracker = AlphaBetaTracker()
+        self.tracked_frames = 0
+
+        # Frames the motion gate let go without processing
+        self.skipped_frames = 0
+        self.skipped_in_row = 0
+
+        # Thread pool and per-strip scratch images while strip_workers > 1
+        self.strip_count = 1
+        self.strip_pool = None
+        self.strip_bufs = []
+
+        self.thresh_low = np.empty(3, dtype=np.uint8)
+        self.thresh_high = np.empty(3, dtype=np.uint8)
 
         self.nt = NetworkTable.getTable('/camera/processor')
 
+        # One record per target and frame, each written with a single NT update
+        self.target_nt = NetworkTable.getTable('/camera')
+        self.records = {name: [0.0] * target_record.FIELDS for name in ('target', 'boiler_target')}
+        self.seqs = dict.fromkeys(self.records, 0)
+
+        # A ClockSync to convert frame timestamps to robot time, if any
+        self.clock = None
+
+        # Bumped by the NT listeners whenever a setting changes
+        self.config = None
+        self.config_version = 0
+        self.applied_version = -1
+
+        self.config_tables = [NetworkTable.getTable(t) for t in ('/camera/processor',
+                                                                 '/camera/processor/thresholds',
+                                                                 '/camera/processor/roi',
+                                                                 '/camera/processor/tracker',
+                                                                 '/camera/processor/boiler',
+                                                                 '/camera/processor/motion')]
+        for table in self.config_tables:
+            table.addTableListener(self._on_config_change, localNotify=True)
+
+        self.refresh_config()
+
+    def _on_config_change(self, source, key, value, isNew):
+        self.config_version += 1
+
+    def refresh_config(self):
+        """
+        Takes a snapshot of the NT settings in `self.config`, rebuilding
+        anything derived from them.
+        """
+        version = self.config_version
+        self.config = cfg = types.SimpleNamespace(**{name: getattr(self, name) for name in self.CONFIG})
+
+        # pixel sizes are set for full size frames
+        cfg.min_width /= self.decode_scale
+        cfg.min_height /= self.decode_scale
+        cfg.broken_tolerance_x /= self.decode_scale
+
+        self.thresh_low[:] = (cfg.thresh_hue_lower, cfg.thresh_sat_lower, cfg.thresh_val_lower)
+        self.thresh_high[:] = (cfg.thresh_hue_high, cfg.thresh_sat_high, cfg.thresh_val_high)
+
+        cfg.strip_workers = max(int(cfg.strip_workers), 1)
+        if cfg.strip_workers != self.strip_count:
+            if self.strip_pool is not None:
+                self.strip_pool.shutdown()
+            self.strip_count = cfg.strip_workers
+            self.strip_pool = ThreadPoolExecutor(cfg.strip_workers) if cfg.strip_workers > 1 else None
+            self.allocate_strips()
+
+        self.applied_version = version
+
+    def load_config(self, path):
+        """
+        Applies settings from a JSON file of {attribute: value}, as written
+        by tune.py. Anything not in CONFIG is ignored.
+        """
+        with open(path) as fp:
+            settings = json.load(fp)
+
+        for name, value in settings.items():
+            if name in self.CONFIG:
+                setattr(self, name, value)
+
+        self.refresh_config()
+
     def preallocate(self, img):
         if self.size is None or self.size[0] != img.shape[0] or self.size[1] != img.shape[1]:
             h, w = img.shape[:2]
@@ -59,184 +273,664 @@ class ImageProcessor:
 
             self.out = np.empty((h, w, 3), dtype=np.uint8)
 
-            # for overlays
-            self.zeros = np.zeros((h, w, 1), dtype=np.bool)
-            self.black = np.zeros((h, w, 3), dtype=np.uint8)
+            small = (h // self.MOTION_SCALE, w // self.MOTION_SCALE, 3)
+            self.motion_small = np.empty(small, dtype=np.uint8)
+            self.motion_ref = np.empty(small, dtype=np.uint8)
+            self.motion_diff = np.empty(small, dtype=np.uint8)
+            self.motion_valid = False
 
             self.morphKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2,2), anchor=(0,0))
 
-        cv2.copyMakeBorder(img, 0, 0, 0, 0, cv2.BORDER_CONSTANT, value=self.RED, dst=self.out)
+            self.roi = None
+
+            self.allocate_strips()
+
+            camera_size = (w * self.decode_scale, h * self.decode_scale)
+            self.angle_lut = angle_maps.load_maps(camera_size)
+            self.set_intrinsics(camera_size)
+
+    def set_intrinsics(self, size):
+        """
+        Uses the lens calibration if there is one, otherwise a pinhole
+        camera with the nominal field of view.
+        """
+        calibration = angle_maps.load_calibration(size)
+
+        if calibration is not None:
+            self.camera_matrix, self.dist_coeffs = calibration
+        else:
+            w, h = size
+            fx = (w / 2.0) / math.tan(math.radians(self.HFOV / 2.0))
+            fy = (h / 2.0) / math.tan(math.radians(self.VFOV / 2.0))
+
+            self.camera_matrix = np.array([[fx, 0, w / 2.0], [0, fy, h / 2.0], [0, 0, 1]])
+            self.dist_coeffs = np.zeros(5)
+
+        self.pose = None
+
+    def allocate_strips(self):
+        if self.strip_pool is None or self.size is None:
+            self.strip_bufs = []
+            return
+
+        h, w = self.size
+        rows = h // self.strip_count + 2 + 2 * self.STRIP_OVERLAP
+
+        self.strip_bufs = [np.empty((rows, w, 1), dtype=np.uint8) for _ in range(self.strip_count)]
+
+    def draw_background(self, img, roi=None):
+        """
+        Fills `self.out` with what the overlays get drawn on top of: the
+        thresholded image or the input frame. Everything is written in place.
+        """
+        if self.config.draw_thresh:
+            if roi is None:
+                cv2.cvtColor(self.bin2, cv2.COLOR_GRAY2BGR, dst=self.out)
+            else:
+                # outside the window the threshold image is stale
+                x0, y0, x1, y1 = roi
+                self.out.fill(0)
+                cv2.cvtColor(self.bin2[y0:y1, x0:x1], cv2.COLOR_GRAY2BGR, dst=self.out[y0:y1, x0:x1])
+        else:
+            np.copyto(self.out, img)
 
-    def threshold(self, img):
-        cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=self.hsv)
-        cv2.inRange(self.hsv, self.thresh_low, self.thresh_high, dst=self.bin)
+    def threshold(self, img, roi=None):
+        if self.strip_pool is not None:
+            return self.threshold_strips(img, roi)
 
-        cv2.morphologyEx(self.bin, cv2.MORPH_CLOSE, self.morphKernel, dst=self.bin2, iterations=1)
+        t = perf_counter()
 
-        if self.draw_thresh:
-            b = (self.bin2 != 0)
-            cv2.copyMakeBorder(self.black, 0, 0, 0, 0, cv2.BORDER_CONSTANT, value=self.RED, dst=self.out)
-            self.out[np.dstack((b, b, b))] = 255
+        # Work on views of the preallocated buffers when limited to a window
+        if roi is None:
+            src, hsv, thresh, closed = img, self.hsv, self.bin, self.bin2
+        else:
+            x0, y0, x1, y1 = roi
+            src = img[y0:y1, x0:x1]
+            hsv = self.hsv[y0:y1, x0:x1]
+            thresh = self.bin[y0:y1, x0:x1]
+            closed = self.bin2[y0:y1, x0:x1]
 
-        return self.bin2
+        cv2.cvtColor(src, cv2.COLOR_BGR2HSV, dst=hsv)
+        cv2.inRange(hsv, self.thresh_low, self.thresh_high, dst=thresh)
+        t = self.times.lap('threshold', t)
 
-    def find_contours(self, img):
+        cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, self.morphKernel, dst=closed, iterations=1)
+        self.times.lap('morphology', t)
 
-        thresh_img = self.threshold(img)
+        if self.render:
+            self.draw_background(img, roi)
 
-        _, contours, _ = cv2.findContours(thresh_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        return closed
+
+    def threshold_strips(self, img, roi=None):
+        """
+        Same as :meth:`threshold`, but on horizontal strips in parallel (cv2
+        releases the GIL). Each strip is converted and thresholded straight
+        into the shared images, then closed from the threshold image a few
+        rows beyond its own, so the result is identical.
+        """
+        t = perf_counter()
+
+        h, w = self.size
+        x0, y0, x1, y1 = (0, 0, w, h) if roi is None else roi
+
+        bounds = np.linspace(y0, y1, len(self.strip_bufs) + 1).astype(int)
+        strips = list(zip(bounds[:-1], bounds[1:]))
+
+        def threshold(strip):
+            a, b = strip
+            hsv = self.hsv[a:b, x0:x1]
+            cv2.cvtColor(img[a:b, x0:x1], cv2.COLOR_BGR2HSV, dst=hsv)
+            cv2.inRange(hsv, self.thresh_low, self.thresh_high, dst=self.bin[a:b, x0:x1])
+
+        def close(i):
+            a, b = strips[i]
+            ea = max(a - self.STRIP_OVERLAP, y0)
+            eb = min(b + self.STRIP_OVERLAP, y1)
+
+            closed = self.strip_bufs[i][:eb - ea, :x1 - x0]
+            cv2.morphologyEx(self.bin[ea:eb, x0:x1], cv2.MORPH_CLOSE, self.morphKernel, dst=closed, iterations=1)
+            self.bin2[a:b, x0:x1] = closed[a - ea:b - ea]
+
+        # every strip must be thresholded before any is closed
+        list(self.strip_pool.map(threshold, strips))
+        t = self.times.lap('threshold', t)
+
+        list(self.strip_pool.map(close, range(len(strips))))
+        self.times.lap('morphology', t)
+
+        if self.render:
+            self.draw_background(img, roi)
+
+        return self.bin2[y0:y1, x0:x1]
+
+    def find_contours(self, img, roi=None):
+        cfg = self.config
+
+        thresh_img = self.threshold(img, roi)
+        t = perf_counter()
+
+        # contours found in a window still come back in full frame coordinates
+        offset = (0, 0) if roi is None else roi[:2]
+
+        _, contours, _ = cv2.findContours(thresh_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
         result = []
+        boxes = []
+        area = []
         for cnt in contours:
             approx = cv2.approxPolyDP(cnt, 0.01*cv2.arcLength(cnt, True), True)
 
-            if self.draw_approx:
+            if self.render and cfg.draw_approx:
                 cv2.drawContours(self.out, [approx], -1, self.BLUE, 2, lineType=8)
 
             if len(approx) > 3 and len(approx) < 15:
                 _, _, w, h = cv2.boundingRect(approx)
-                if h > self.min_height and w > self.min_width:
+                if h > cfg.min_height and w > cfg.min_width:
                         hull = cv2.convexHull(cnt)
                         approx2 = cv2.approxPolyDP(hull,0.01*cv2.arcLength(hull,True),True)
 
-                        if self.draw_approx2:
+                        if self.render and cfg.draw_approx2:
                             cv2.drawContours(self.out, [approx2], -1, self.GREEN, 2, lineType=8)
 
                         result.append(approx2)
-        return result
+                        boxes.append(cv2.boundingRect(approx2))
+                        area.append(cv2.contourArea(approx2))
+
+        features = make_features(np.array(boxes, dtype=np.float64).reshape(-1, 4), area)
+        self.times.lap('contours', t)
+        return features, result.__getitem__
+
+    def find_blobs(self, img, roi=None):
+        """
+        Alternative to :meth:`find_contours`: labels all blobs in one pass and
+        filters them on their stats, so no polygon work is done up front.
+        Polygons are only traced for the blobs that actually get used, and
+        only once per frame. Areas are pixel counts rather than polygon areas.
+        """
+        cfg = self.config
+
+        thresh_img = self.threshold(img, roi)
+        t = perf_counter()
+
+        x0, y0 = (0, 0) if roi is None else roi[:2]
+
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(thresh_img, connectivity=8, ltype=cv2.CV_32S)
+
+        # label 0 is the background
+        stats = stats[1:]
+        keep = np.flatnonzero((stats[:, cv2.CC_STAT_WIDTH] > cfg.min_width) &
+                              (stats[:, cv2.CC_STAT_HEIGHT] > cfg.min_height))
+
+        # Labels are numbered in raster order, findContours returns the same
+        # blobs in reverse. Grouping depends on the order, so match it.
+        keep = keep[::-1]
+
+        boxes = stats[keep, :4].astype(np.float64)
+        boxes[:, 0] += x0
+        boxes[:, 1] += y0
+
+        features = make_features(boxes, stats[keep, cv2.CC_STAT_AREA])
+        self.times.lap('contours', t)
+
+        hulls = {}
+
+        def polygon(i):
+            if i not in hulls:
+                hulls[i] = trace(i)
+            return hulls[i]
+
+        def trace(i):
+            label = keep[i] + 1
+            x, y, w, h = stats[keep[i], :4]
+
+            mask = cv2.compare(labels[y:y+h, x:x+w], int(label), cv2.CMP_EQ)
+            _, contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x + x0), int(y + y0)))
+
+            hull = cv2.convexHull(max(contours, key=len))
+            return cv2.approxPolyDP(hull, 0.01*cv2.arcLength(hull, True), True)
 
-    def get_contour_info(self, contour):
-        contour_info = {}
+        return features, polygon
 
-        contour_info['x'], contour_info['y'], contour_info['w'], contour_info['h'] = cv2.boundingRect(contour)
+    def group_targets(self, features):
+        """
+        Patches broken gear targets back together the same way the original
+        nested loops did: each candidate is merged with the first later
+        candidate whose center is within `broken_tolerance_x`, and every
+        candidate gives one target, merged or not. Only pairs are merged, so
+        a column of noise can't turn into one tall target. The center
+        distances are computed at once as an NxN comparison; picking the
+        partners is still a loop over the candidates.
 
-        contour_info['cx'] = contour_info['x'] + contour_info['w'] / 2
-        contour_info['cy'] = contour_info['y'] + contour_info['h'] / 2
+        :param features: FEATURES array, one row per candidate
+        :return: (groups, targets) where groups holds the candidate indices
+                 making up each target, and targets is a FEATURES array of
+                 their combined bounding boxes
+        """
+        cfg = self.config
 
-        return contour_info
+        n = len(features)
+        if n == 0:
+            return [], np.empty(0, dtype=FEATURES)
 
-    def process_for_gear_target(self, contours, time):
-        # Filter contours for complete gear targets and possible 'broken gear targets'
-        self.targets = []
+        cx = features['cx']
+        close = np.abs(cx[:, None] - cx[None, :]) <= cfg.broken_tolerance_x
+
+        partner = np.arange(n)
+        merged = 0
+        for i in range(n):
+            # The original removed every merged candidate from the list it
+            # was still walking, which skipped that many candidates after it
+            first = i + 1 + merged
+            later = np.flatnonzero(close[i, first:])
+            if len(later):
+                partner[i] = first + later[0]
+                merged += 1
+
+        groups = [(i,) if j == i else (i, j) for i, j in enumerate(partner)]
+
+        # Bounding box of each pair, all pairs at once
+        a, b = features, features[partner]
+
+        x0 = np.minimum(a['x'], b['x'])
+        y0 = np.minimum(a['y'], b['y'])
+        x1 = np.maximum(a['x'] + a['w'], b['x'] + b['w'])
+        y1 = np.maximum(a['y'] + a['h'], b['y'] + b['h'])
 
-        for c in contours:
-            target_info = self.get_contour_info(c)
-            target_info['cnt'] = c
+        area = np.where(partner == np.arange(n), a['area'], a['area'] + b['area'])
+        targets = make_features(np.column_stack((x0, y0, x1 - x0, y1 - y0)), area)
 
-            self.targets.append(target_info)
+        return groups, targets
+
+    def angle_target(self, groups):
+        """
+        The original loops measured the angle and height from whatever they
+        looked at last: the last merged pair if there was one, otherwise the
+        last candidate. AutoAlign.ideal_angle was measured against that, so
+        it is kept until the angle can be re-measured on the robot.
 
-        self.full_targets = []
-        # Groups contours together if within a certain tolerance
-        for i, b in enumerate(self.targets[:]):
-            matched = False
-            for i2, b2 in enumerate(self.targets[i+1:]):
-                if b['cx'] >= b2['cx'] - self.broken_tolerance_x and b['cx'] <= b2['cx'] + self.broken_tolerance_x:
-                    matched = True
-                    new_blob = np.concatenate([b['cnt'], b2['cnt']])
+        :param groups: as returned by group_targets()
+        :return: index of the target the angle is measured from
+        """
+        for i in range(len(groups) - 1, -1, -1):
+            if len(groups[i]) > 1:
+                return i
 
-                    hull = cv2.convexHull(new_blob)
-                    new_blob = cv2.approxPolyDP(hull, 0.01*cv2.arcLength(hull, True), True)
+        return len(groups) - 1
+
+    def select_targets(self, targets):
+        """
+        Picks the primary target (the right-most one) and, if there is one
+        within `gear_spacing` target heights of it, the secondary target
+        (the next one to its left).
 
-                    target_info = self.get_contour_info(new_blob)
-                    target_info['cnt'] = new_blob
+        :return: (primary index, secondary index or None)
+        """
+        cfg = self.config
 
-                    self.full_targets.append(target_info)
-                    self.targets.remove(b)
+        cx = targets['cx']
 
-                    break
-            if not matched:
-                self.full_targets.append(b)
+        primary = int(np.argmax(cx))
+
+        if len(cx) == 1:
+            return primary, None
+
+        # the closest target to the primary is the largest of the rest
+        rest = cx.copy()
+        rest[primary] = -np.inf
+        secondary = int(np.argmax(rest))
+
+        if abs(cx[secondary] - cx[primary]) < cfg.gear_spacing * targets['h'][primary]:
+            return primary, secondary
+
+        return primary, None
+
+    def process_for_gear_target(self, features, polygon, time):
+        cfg = self.config
+        t = perf_counter()
+
+        # Filter contours for complete gear targets and possible 'broken gear targets'
+        groups, self.full_targets = self.group_targets(features)
 
         # Draws gears after `patching` them together
-        if self.draw_gear_patch:
-            contours = []
-            for g in self.full_targets:
-                cv2.drawContours(self.out, [g['cnt']], -1, self.YELLOW, 2, lineType=8)
-                contours.append(g['cnt'])
+        if self.render and cfg.draw_gear_patch:
+            for g in groups:
+                contour = np.concatenate([polygon(i) for i in g])
+                cv2.drawContours(self.out, [cv2.convexHull(contour)], -1, self.YELLOW, 2, lineType=8)
 
         # Breaks out of loop if no complete targets
         if len(self.full_targets) == 0:
-            self.nt.putBoolean('gear_target_present', False)
+            self.main_target_contour = None
+            self.target_state = None
+            self.pose = None
+            self.times.lap('grouping', t)
+            self.publish_target(time, False)
             return self.out
 
-        # Finds the target that is closest to the center
-        h = float(self.size[0])
-        w = float(self.size[1])
-
-        primary_target = None
-        for i, g in enumerate(self.full_targets[:]):
-            greater_than = True
+        p, s = self.select_targets(self.full_targets)
 
-            for g2 in self.full_targets[i+1:]:
-                if g['cx'] - (h / 2) < g2['cx'] - (h / 2):
-                    greater_than = False
+        targets = self.full_targets
 
-            if greater_than:
-                primary_target = g
-                self.full_targets.remove(g)
-                break
+        primary_h, primary_cx = targets['h'][p], targets['cx'][p]
+        scale = self.decode_scale
+        members = groups[p]
 
         # Finds the another close gear target if present
-        main_target_contour = primary_target['cnt']
-        secondary_target = None
         partial = True
-        if len(self.full_targets) > 0:
-            for i, g in enumerate(self.full_targets):
-                greater_than = True
-
-                if abs(g['cx'] - primary_target['cx']) < self.gear_spacing * primary_target['h']:
-
-                    for g2 in self.full_targets[i:]:
-                        if g['cx'] - (h / 2) < g2['cx'] - (h / 2):
-                            greater_than = False
-                else:
-                    greater_than = False
+        if s is not None:
+            secondary_h, secondary_cx = targets['h'][s], targets['cx'][s]
+            members = np.concatenate([groups[s], members])
+            partial = False
 
-                if greater_than:
-                    secondary_target = self.get_contour_info(g['cnt'])
-                    main_target_contour = np.concatenate([g['cnt'], main_target_contour])
-                    partial = False
-                    break
+        # Only the polygons of the chosen targets are ever needed
+        main_target_contour = np.concatenate([polygon(i) for i in members])
 
         # Preforms math on contours to make them useful
         hull = cv2.convexHull(main_target_contour)
         main_target_contour = cv2.approxPolyDP(hull, 0.01*cv2.arcLength(hull, True), True)
 
-        height = self.VFOV * target_info['cy'] / h - self.VFOV/2.0
-        angle = self.HFOV * target_info['cx'] / w - self.HFOV/2.0
+        x, y, w, h = cv2.boundingRect(main_target_contour)
+        cx, cy = (x + w / 2) * scale, (y + h / 2) * scale
 
-        self.nt.putBoolean('gear_target_present', True)
-        self.nt.putBoolean('gear_target_partial', partial)
+        a = self.angle_target(groups)
+        angle, height = self.get_angles(targets['cx'][a] * scale, targets['cy'][a] * scale)
 
-        skew = None
+        skew = 0.0
         if not partial:
-            if primary_target['h'] < secondary_target['h']:
-                skew = secondary_target['h']/primary_target['h']
+            if primary_h < secondary_h:
+                skew = secondary_h/primary_h
                 skew -= 1
-                if primary_target['cx'] < secondary_target['cx']:
+                if primary_cx < secondary_cx:
                     skew *= -1
             else:
-                skew = primary_target['h']/secondary_target['h']
+                skew = primary_h/secondary_h
                 skew -= 1
-                if secondary_target['cx'] < primary_target['cx']:
+                if secondary_cx < primary_cx:
                     skew *= -1
 
-            self.nt.putNumber('gear_target_skew', skew)
+        t = self.times.lap('grouping', t)
 
-            target = (angle, skew, time)
+        # primary is the right-most target, so the secondary is the left tape
+        pose = None
+        if partial:
+            self.pose = None
+        else:
+            pose = self.solve_pose(s, p)
+        self.times.lap('pose', t)
 
-            self.nt.putNumberArray('target', target)
+        self.publish_target(time, True, partial, angle, skew, height, pose=pose)
 
-        self.nt.putNumber('gear_target_angle', angle)
-        self.nt.putNumber('gear_target_height', height)
-
-        if self.draw_gear_target:
+        if self.render and cfg.draw_gear_target:
             cv2.drawContours(self.out, [main_target_contour], -1, self.RED, 2, lineType=8)
 
+        self.main_target_contour = main_target_contour
+        self.main_target_partial = partial
+        # in camera pixels, whatever the decode scale
+        self.target_state = (cx, cy, primary_h * scale, skew)
+
+    def solve_pose(self, left, right):
+        """
+        Solves where the peg is from the corners of both tapes. Starts from
+        the last frame's solution when there is one, which takes only a few
+        iterations.
+
+        :param left, right: indices of the two tapes in full_targets
+        :return: (distance, lateral) in feet, or None
+        """
+        targets = self.full_targets
+        scale = self.decode_scale
+
+        image = np.empty((8, 2))
+        for k, i in enumerate((left, right)):
+            x, y = targets['x'][i] * scale, targets['y'][i] * scale
+            w, h = targets['w'][i] * scale, targets['h'][i] * scale
+            image[4 * k:4 * k + 4] = ((x, y), (x + w, y), (x + w, y + h), (x, y + h))
+
+        if self.pose is not None:
+            rvec, tvec = self.pose
+            ok, rvec, tvec = cv2.solvePnP(PEG_MODEL, image, self.camera_matrix, self.dist_coeffs,
+                                          rvec, tvec, True, cv2.SOLVEPNP_ITERATIVE)
+        else:
+            ok, rvec, tvec = cv2.solvePnP(PEG_MODEL, image, self.camera_matrix, self.dist_coeffs,
+                                          flags=cv2.SOLVEPNP_ITERATIVE)
+
+        # behind the camera means it converged on the mirror solution
+        if not ok or tvec[2, 0] <= 0:
+            self.pose = None
+            return None
+
+        self.pose = (rvec, tvec)
+        return float(tvec[2, 0]), float(tvec[0, 0])
+
+    def process_for_boiler_target(self, features, time):
+        """
+        The boiler tape is two wide strips, one above the other. Works on
+        the same candidates as the gear target, so the only extra cost is
+        this classifier.
+        """
+        cfg = self.config
+        t = perf_counter()
+
+        strips = features[features['aspect'] > cfg.boiler_min_aspect]
+
+        if len(strips) == 0:
+            self.times.lap('boiler', t)
+            self.publish_target(time, False, name='boiler_target')
+            return
+
+        x, y, w, h, cx = strips['x'], strips['y'], strips['w'], strips['h'], strips['cx']
+
+        # top[i] and bottom[j] pair up if j is centered under i, close enough
+        below = y[None, :] - y[:, None]
+        pairs = ((np.abs(cx[None, :] - cx[:, None]) < w[:, None] / 2) &
+                 (below > 0) & (below < cfg.boiler_spacing * h[:, None]))
+
+        # the widest strip, or the widest top strip of a pair
+        has_pair = pairs.any(axis=1)
+        partial = not has_pair.any()
+        top = int(np.argmax(np.where(has_pair | partial, w, -1)))
+
+        scale = self.decode_scale
+        angle, height = self.get_angles(cx[top] * scale, strips['cy'][top] * scale)
+
+        self.times.lap('boiler', t)
+        self.publish_target(time, True, partial, angle, 0.0, height, name='boiler_target')
+
+        if self.render and cfg.draw_boiler_target:
+            x0, y0 = int(x[top]), int(y[top])
+            cv2.rectangle(self.out, (x0, y0), (x0 + int(w[top]), y0 + int(h[top])), self.BLUE, 2)
+
+    def get_angles(self, cx, cy):
+        """
+        :param cx, cy: point in camera pixels
+        :return: (angle, height) in degrees of a point in the image
+        """
+        if self.angle_lut is not None:
+            return angle_maps.lookup(self.angle_lut, cx, cy)
+
+        h = float(self.size[0] * self.decode_scale)
+        w = float(self.size[1] * self.decode_scale)
+
+        height = self.VFOV * cy / h - self.VFOV/2.0
+        angle = self.HFOV * cx / w - self.HFOV/2.0
+
+        return angle, height
+
+    def publish_target(self, time, present, partial=True, angle=0.0, skew=0.0, height=0.0, extrapolated=False,
+                       name='target', pose=None):
+        """
+        Publishes everything known about the target in this frame as one
+        record, see :mod:`target_record` for the layout.
+
+        :param name: key under /camera, 'target' for the gear target
+        :param pose: (distance, lateral) in feet, if solved
+        """
+        t = perf_counter()
+        self.seqs[name] += 1
+
+        record = self.records[name]
+        record[target_record.SEQ] = self.seqs[name]
+        self.stamp(record, time)
+        record[target_record.PRESENT] = float(present)
+        record[target_record.PARTIAL] = float(partial)
+        record[target_record.ANGLE] = angle
+        record[target_record.SKEW] = skew
+        record[target_record.HEIGHT] = height
+        record[target_record.EXTRAPOLATED] = float(extrapolated)
+        record[target_record.POSE] = float(pose is not None)
+        record[target_record.DISTANCE], record[target_record.LATERAL] = pose or (0.0, 0.0)
+
+        self.target_nt.putNumberArray(name, record)
+        self.times.lap('publish', t)
+
+    def stamp(self, record, time):
+        """
+        Sets the TIMESTAMP and SYNCED fields of a record from a frame time.
+        """
+        if self.clock is not None:
+            ts, synced = self.clock.to_robot(self.clock.from_frame(time))
+        else:
+            ts, synced = time / 1e6, False
+
+        record[target_record.TIMESTAMP] = ts
+        record[target_record.SYNCED] = float(synced)
+
+    def republish(self, time):
+        """
+        Publishes the last records again as new ones for this frame.
+        """
+        t = perf_counter()
+
+        for name, record in self.records.items():
+            if self.seqs[name] == 0:
+                continue
+
+            self.seqs[name] += 1
+            record[target_record.SEQ] = self.seqs[name]
+            self.stamp(record, time)
+            self.target_nt.putNumberArray(name, record)
+
+        self.times.lap('publish', t)
+
+    def unchanged(self, frame):
+        """
+        Motion gate: whether `frame` looks the same as the last frame that
+        was processed, going by a small copy of both.
+        """
+        cfg = self.config
+        t = perf_counter()
+
+        h, w = self.motion_small.shape[:2]
+        cv2.resize(frame, (w, h), dst=self.motion_small, interpolation=cv2.INTER_AREA)
+
+        same = False
+        if self.motion_valid and self.skipped_in_row < cfg.motion_max_skip:
+            cv2.absdiff(self.motion_small, self.motion_ref, dst=self.motion_diff)
+            same = sum(cv2.mean(self.motion_diff)[:3]) / 3 < cfg.motion_threshold
+
+        if not same:
+            # compare against the frame actually processed, so slow changes add up
+            np.copyto(self.motion_ref, self.motion_small)
+            self.motion_valid = True
+
+        self.times.lap('motion', t)
+        return same
+
+    def get_roi(self):
+        """
+        :return: A padded window around the last main target, or None if
+                 there is no target to track
+        """
+        cfg = self.config
+
+        if self.main_target_contour is None:
+            return None
+
+        x, y, w, h = cv2.boundingRect(self.main_target_contour)
+
+        pad_y = int(cfg.roi_padding * h) + 1
+        pad_x = pad_y
+
+        # the other half of a partial target may be up to gear_spacing away
+        if self.main_target_partial:
+            pad_x += int(cfg.gear_spacing * h)
+
+        img_h, img_w = self.size
+
+        return (max(x - pad_x, 0), max(y - pad_y, 0),
+                min(x + w + pad_x, img_w), min(y + h + pad_y, img_h))
+
+    def extrapolate_target(self, frame, time):
+        cx, cy, _, skew = self.tracker.predict(time)
+        angle, height = self.get_angles(cx, cy)
+
+        self.publish_target(time, True, False, angle, skew, height, extrapolated=True)
+
+        if self.render:
+            np.copyto(self.out, frame)
+            cv2.circle(self.out, (int(cx / self.decode_scale), int(cy / self.decode_scale)), 4, self.YELLOW, 2)
+
     def process_frame(self, frame, time):
+        t = perf_counter()
+
+        if self.applied_version != self.config_version:
+            self.refresh_config()
+
+        cfg = self.config
+
         self.preallocate(frame)
 
-        cnt = self.find_contours(frame)
+        if cfg.motion_enabled:
+            if self.unchanged(frame):
+                self.skipped_frames += 1
+                self.skipped_in_row += 1
+                self.republish(time)
 
-        self.process_for_gear_target(cnt, time)
+                self.times.lap('total', t)
+                return self.out
+
+            self.skipped_in_row = 0
+
+        # In between full detections, publish where the tracker thinks the
+        # target is, as long as it has measured one and is confident enough
+        if (cfg.tracker_enabled and not cfg.boiler_enabled and self.tracked_frames < cfg.tracker_interval - 1 and
+                self.tracker.x is not None and self.tracker.confidence >= cfg.tracker_min_confidence):
+            self.tracked_frames += 1
+            self.extrapolate_target(frame, time)
+
+            self.times.lap('total', t)
+            return self.out
 
+        self.tracked_frames = 0
+
+        # Search only around the last target, but look at the whole frame
+        # every so often so a better target doesn't go unnoticed
+        roi = None
+        if (cfg.roi_enabled and not cfg.boiler_enabled and self.roi is not None and
+                self.roi_frames < cfg.roi_full_interval):
+            roi = self.roi
+            self.roi_frames += 1
+        else:
+            self.roi_frames = 0
+
+        if cfg.detector == 'components':
+            features, polygon = self.find_blobs(frame, roi)
+        else:
+            features, polygon = self.find_contours(frame, roi)
+
+        # every classifier works on the same candidates
+        self.process_for_gear_target(features, polygon, time)
+        if cfg.boiler_enabled:
+            self.process_for_boiler_target(features, time)
+
+        # If the target was lost this is None, and the next frame is a full search
+        self.roi = self.get_roi()
+
+        # Partial targets are centered on one tape, so they can't be tracked
+        # together with full ones
+        if self.target_state is not None and not self.main_target_partial:
+            self.tracker.update(self.target_state, time)
+        else:
+            self.tracker.reset()
+
+        self.times.lap('total', t)
         return self.out
@@ -0,0 +1,142 @@
+"""
+Records raw frames into a preallocated, memory-mapped ring file, so we can
+look at what the camera saw during a match afterwards.
+
+File layout (all little endian):
+
+    header   8 x uint64: magic, version, slots, height, width, channels,
+             frames written, reserved
+    stamps   slots x float64 cscore timestamps
+    frames   slots x height x width x channels uint8
+
+The slot of frame number n is n % slots.
+"""
+
+import mmap
+import os
+import threading
+
+import numpy as np
+
+MAGIC = 0x43455256  # 'VREC'
+VERSION = 1
+
+HEADER = np.dtype('<u8')
+HEADER_FIELDS = 8
+STAMP = np.dtype('<f8')
+
+# header fields
+SLOTS = 2
+HEIGHT = 3
+WIDTH = 4
+CHANNELS = 5
+WRITTEN = 6
+
+
+def _map(mm, slots, shape):
+    """
+    :return: (header, stamps, frames) views onto a mapped ring file
+    """
+    header = np.frombuffer(mm, dtype=HEADER, count=HEADER_FIELDS)
+    offset = HEADER.itemsize * HEADER_FIELDS
+
+    stamps = np.frombuffer(mm, dtype=STAMP, count=slots, offset=offset)
+    offset += STAMP.itemsize * slots
+
+    frames = np.frombuffer(mm, dtype=np.uint8, count=slots * int(np.prod(shape)), offset=offset)
+    return header, stamps, frames.reshape((slots,) + tuple(shape))
+
+
+def _file_size(slots, shape):
+    return HEADER.itemsize * HEADER_FIELDS + STAMP.itemsize * slots + slots * int(np.prod(shape))
+
+
+class FrameRecorder:
+    """
+    Recording a frame is a single copy into its mapped slot; a writer
+    thread flushes the file to disk in the background.
+
+    The whole file is allocated up front, so a full disk fails here with
+    OSError instead of with SIGBUS on some later write to the map. If a
+    flush fails, the next :meth:`record` raises it.
+    """
+
+    def __init__(self, path, shape, slots=300, flush_interval=0.5):
+        self.path = path
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.flush_interval = flush_interval
+
+        size = _file_size(slots, self.shape)
+        with open(path, 'w+b') as fp:
+            fp.truncate(size)
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fp.fileno(), 0, size)
+            self.mm = mmap.mmap(fp.fileno(), size)
+
+        self.header, self.stamps, self.frames = _map(self.mm, slots, self.shape)
+        self.header[:] = (MAGIC, VERSION, slots) + self.shape + (0, 0)
+
+        self.written = 0
+        self.error = None
+
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, img, ts):
+        if self.error is not None:
+            raise self.error
+
+        if img.shape != self.shape:
+            return
+
+        i = self.written % self.slots
+
+        self.frames[i][...] = img
+        self.stamps[i] = ts
+
+        self.written += 1
+        self.header[WRITTEN] = self.written
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+
+        # drop our views before the map goes away
+        del self.header, self.stamps, self.frames
+        self.mm.close()
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            try:
+                self.mm.flush()
+            except OSError as e:
+                self.error = e
+                return
+
+
+def read_ring_file(path):
+    """
+    Reads back a file written by :class:`FrameRecorder`.
+
+    :return: list of (timestamp, frame), oldest first
+    """
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = np.frombuffer(mm, dtype=HEADER, count=HEADER_FIELDS)
+    if header[0] != MAGIC or header[1] != VERSION:
+        raise ValueError('%s is not a vision recording' % path)
+
+    slots = int(header[SLOTS])
+    shape = (int(header[HEIGHT]), int(header[WIDTH]), int(header[CHANNELS]))
+    written = int(header[WRITTEN])
+
+    _, stamps, frames = _map(mm, slots, shape)
+
+    first = max(written - slots, 0)
+    return [(float(stamps[n % slots]), frames[n % slots].copy()) for n in range(first, written)]
@@ -0,0 +1,98 @@
+"""
+Plays back recorded frames in place of a camera, so the whole vision loop
+can run on a laptop without any camera attached.
+"""
+
+import glob
+import os.path
+import time
+
+import cv2
+import numpy as np
+
+from recorder import read_ring_file
+
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png')
+
+# cscore timestamps are in microseconds
+TIMESTAMP_SCALE = 1e6
+
+
+def load_frames(path, fps=20):
+    """
+    Loads a directory of images, a video file or a ring file written by
+    :class:`recorder.FrameRecorder`.
+
+    :param fps: frame rate to make up timestamps for images
+    :return: list of (timestamp, frame)
+    """
+    if os.path.isdir(path):
+        fnames = sorted(f for ext in IMAGE_EXTENSIONS for f in glob.glob(os.path.join(path, ext)))
+        return [((i + 1) * TIMESTAMP_SCALE / fps, cv2.imread(f)) for i, f in enumerate(fnames)]
+
+    if path.endswith('.rec'):
+        return read_ring_file(path)
+
+    frames = []
+    capture = cv2.VideoCapture(path)
+
+    # the first frame is at 0 ms, but a timestamp of 0 means a failed grab
+    offset = TIMESTAMP_SCALE / (capture.get(cv2.CAP_PROP_FPS) or fps)
+
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append((capture.get(cv2.CAP_PROP_POS_MSEC) * TIMESTAMP_SCALE / 1000.0 + offset, frame))
+
+    capture.release()
+    return frames
+
+
+class ReplaySource:
+    """
+    Hands out frames through the same grabFrame/getError interface as
+    cscore's CvSink, either as fast as they are asked for or spaced out
+    like their original timestamps. The exposure calls of UsbCamera are
+    accepted and ignored, so it can stand in for the camera as well.
+    """
+
+    def __init__(self, path, realtime=False):
+        self.frames = load_frames(path)
+        self.realtime = realtime
+
+        self.index = 0
+        self.start = None
+        self.finished = False
+
+    def grabFrame(self, img):
+        if self.index >= len(self.frames):
+            self.finished = True
+            return 0, img
+
+        ts, frame = self.frames[self.index]
+        self.index += 1
+
+        if self.realtime:
+            first_ts = self.frames[0][0]
+            if self.start is None:
+                self.start = time.monotonic()
+
+            delay = self.start + (ts - first_ts) / TIMESTAMP_SCALE - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if img is None or img.shape != frame.shape:
+            img = np.empty_like(frame)
+
+        np.copyto(img, frame)
+        return ts, img
+
+    def getError(self):
+        return 'end of replay' if self.finished else ''
+
+    def setExposureAuto(self):
+        pass
+
+    def setExposureManual(self, value):
+        pass
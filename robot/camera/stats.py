@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from time import perf_counter
+
+import numpy as np
+
+
+class StageTimes:
+    """
+    Keeps the durations of the last `size` runs of each pipeline stage in
+    fixed-size rings, so recording never allocates.
+    """
+
+    def __init__(self, stages, size=256):
+        self.size = size
+        self.samples = {stage: np.zeros(size) for stage in stages}
+        self.count = dict.fromkeys(stages, 0)
+
+    def record(self, stage, seconds):
+        n = self.count[stage]
+        self.samples[stage][n % self.size] = seconds
+        self.count[stage] = n + 1
+
+    def lap(self, stage, start):
+        """
+        Records the time since `start` for `stage`.
+
+        :return: the current time, to be used as the start of the next stage
+        """
+        now = perf_counter()
+        self.record(stage, now - start)
+        return now
+
+    def reset(self):
+        for stage in self.count:
+            self.count[stage] = 0
+
+    def summary(self, stage):
+        """
+        :return: dict of mean, p50, p95 and p99 in milliseconds over the
+                 runs still kept, or None if the stage never ran
+        """
+        n = min(self.count[stage], self.size)
+        if n == 0:
+            return None
+
+        samples = self.samples[stage][:n] * 1000.0
+        p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+
+        return {'mean': float(samples.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+class StatsPublisher:
+    """
+    Publishes the health of the vision process to a table about once per
+    interval, from its own thread. The vision loop only bumps plain
+    counters and StageTimes rings; everything else happens here.
+    """
+
+    def __init__(self, table, interval=1.0):
+        self.table = table
+        self.interval = interval
+
+        # name -> (function returning a running total, publish as a rate)
+        self.counters = {}
+        self.times = None
+
+    def add_counter(self, name, get, rate=False):
+        """
+        :param get: returns the current value
+        :param rate: `get` is an ever increasing counter, publish how much
+                     it went up per second
+        """
+        self.counters[name] = (get, rate)
+
+    def add_times(self, times):
+        """
+        Publishes the mean and p95 of every stage of a :class:`StageTimes`.
+        """
+        self.times = times
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        wall = time.monotonic()
+        cpu = time.process_time()
+        last = {name: get() for name, (get, _) in self.counters.items()}
+
+        while True:
+            time.sleep(self.interval)
+
+            now = time.monotonic()
+            now_cpu = time.process_time()
+            elapsed = now - wall
+
+            for name, (get, rate) in self.counters.items():
+                value = get()
+                if rate:
+                    self.table.putNumber(name, (value - last[name]) / elapsed)
+                else:
+                    self.table.putNumber(name, value)
+                last[name] = value
+
+            if self.times is not None:
+                for stage in self.times.samples:
+                    summary = self.times.summary(stage)
+                    if summary is not None:
+                        self.table.putNumber('%s_mean_ms' % stage, summary['mean'])
+                        self.table.putNumber('%s_p95_ms' % stage, summary['p95'])
+
+            # all threads of the process, as a fraction of one core
+            self.table.putNumber('cpu_load', (now_cpu - cpu) / elapsed)
+
+            rss = memory_usage()
+            if rss is not None:
+                self.table.putNumber('memory_mb', rss / 1e6)
+
+            wall = now
+            cpu = now_cpu
+
+
+def memory_usage():
+    """
+    :return: resident memory of this process in bytes, or None if unknown
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
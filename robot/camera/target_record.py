@@ -0,0 +1,24 @@
+"""
+Layout of the target records the vision process publishes once per
+processed frame, as a single number array: the gear target to
+/camera/target and the boiler target to /camera/boiler_target. All values
+of a record come from the same frame.
+
+This module is shared by the vision process and the robot code, so it must
+not import anything.
+"""
+
+SEQ = 0  # increases by one with every record
+TIMESTAMP = 1  # capture time of the frame, robot seconds if SYNCED
+PRESENT = 2  # 1 if a target was found
+PARTIAL = 3  # 1 if only one of the two tapes was found
+ANGLE = 4  # horizontal angle to the target, degrees
+SKEW = 5  # height ratio of the two tapes, 0 for partial targets
+HEIGHT = 6  # vertical angle to the target, degrees
+EXTRAPOLATED = 7  # 1 if predicted by the tracker instead of detected
+SYNCED = 8  # 1 if TIMESTAMP is in robot time, else vision process seconds
+POSE = 9  # 1 if DISTANCE and LATERAL were solved for this frame
+DISTANCE = 10  # feet from the camera to the peg, along the camera axis
+LATERAL = 11  # feet the peg is to the right of the camera axis
+
+FIELDS = 12
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class AlphaBetaTracker:
+    """
+    Alpha-beta filter over a small state vector (for the gear target: cx,
+    cy, height and skew). Between measurements it predicts the state
+    assuming constant velocity.
+
+    `confidence` is 1 right after a measurement that matched the
+    prediction, falls as measurements disagree with it, and decays with
+    every prediction made without a new measurement.
+    """
+
+    def __init__(self, alpha=0.5, beta=0.1, decay=0.8):
+        self.alpha = alpha
+        self.beta = beta
+        self.decay = decay
+
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.v = None
+        self.t = None
+        self.confidence = 0.0
+
+    def update(self, measurement, t):
+        """
+        :param measurement: array of the measured state
+        :param t: time the measurement was taken
+        """
+        measurement = np.asarray(measurement, dtype=np.float64)
+
+        if self.x is None or t <= self.t:
+            self.x = measurement
+            self.v = np.zeros_like(measurement)
+            self.t = t
+            self.confidence = 1.0
+            return
+
+        dt = t - self.t
+        predicted = self.x + self.v * dt
+        residual = measurement - predicted
+
+        self.x = predicted + self.alpha * residual
+        self.v = self.v + self.beta * residual / dt
+        self.t = t
+
+        # how far off the prediction was, in target heights (element 2)
+        error = abs(residual[0]) / max(abs(measurement[2]), 1.0)
+        self.confidence = 1.0 / (1.0 + error)
+
+    def predict(self, t):
+        """
+        :return: the predicted state at time `t`, or None if nothing has
+                 been measured yet
+        """
+        if self.x is None:
+            return None
+
+        self.confidence *= self.decay
+        return self.x + self.v * (t - self.t)
@@ -0,0 +1,150 @@
+"""
+Searches the HSV thresholds and minimum target size that make ImageProcessor
+find the labelled targets of a set of images, and writes them to a file the
+vision process loads at startup.
+
+    python3 tune.py [-o thresholds.json] [--labels labels.json] [--images dir]
+
+Labels are in the format of golden.py. By default the golden images are
+used, but those were labelled by the current detector, so there is little
+for the search to improve on. Label frames from the field by hand (e.g.
+from a recording, see replay.py) to tune for them; image names are relative
+to --images, which defaults to the directory of the label file.
+
+The search goes over one setting at a time, trying all its candidate values
+in parallel and keeping the best, until a whole round changes nothing.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import golden
+
+# ImageProcessor attribute -> candidate values
+SEARCH = (
+    ('thresh_hue_lower', range(0, 180, 4)),
+    ('thresh_hue_high', range(40, 181, 4)),
+    ('thresh_sat_lower', range(0, 256, 8)),
+    ('thresh_sat_high', range(127, 256, 8)),
+    ('thresh_val_lower', range(0, 256, 8)),
+    ('thresh_val_high', range(127, 256, 8)),
+    ('min_width', range(1, 9)),
+    ('min_height', range(1, 9)),
+)
+
+NAMES = tuple(name for name, _ in SEARCH)
+
+# loaded once per worker process
+_worker = None
+
+
+def score(labels_path, images, params):
+    """
+    :param labels_path: label file to score against
+    :param images: directory the label's image names are relative to
+    :param params: values in the order of SEARCH
+    :return: (labels matched, minus the total angle error), higher is better
+    """
+    global _worker
+    if _worker is None:
+        labels = golden.load_labels(labels_path)['frames']
+        _worker = (golden.make_processor(),
+                   [(label, golden.load_image(label['image'], images)) for label in labels])
+
+    processor, frames = _worker
+
+    for name, value in zip(NAMES, params):
+        setattr(processor, name, value)
+    processor.refresh_config()
+
+    matched = 0
+    error = 0.0
+    for label, img in frames:
+        found = golden.detect(processor, img)
+        if not golden.compare(label, found):
+            matched += 1
+        if label['present'] and found['present'] and label['angle'] is not None:
+            error += abs(found['angle'] - label['angle'])
+
+    return matched, -error
+
+
+class Tuner:
+
+    def __init__(self, executor, score):
+        """
+        :param score: picklable function of a parameter tuple, see score()
+        """
+        self.executor = executor
+        self.score = score
+
+        # parameter tuple -> score, nothing is ever scored twice
+        self.cache = {}
+
+    def score_all(self, candidates):
+        todo = [c for c in set(candidates) if c not in self.cache]
+        for params, result in zip(todo, self.executor.map(self.score, todo, chunksize=4)):
+            self.cache[params] = result
+
+        return [self.cache[c] for c in candidates]
+
+    def tune(self, start):
+        best = tuple(start)
+        best_score = self.score_all([best])[0]
+
+        for n in itertools.count(1):
+            improved = False
+
+            for i, (name, values) in enumerate(SEARCH):
+                candidates = [best[:i] + (v,) + best[i + 1:] for v in values]
+                scores = self.score_all(candidates)
+
+                top = max(range(len(candidates)), key=lambda j: scores[j])
+                if scores[top] > best_score:
+                    best, best_score = candidates[top], scores[top]
+                    improved = True
+
+            print('Round %d: %d matched, angle error %.2f, %d settings tried' %
+                  (n, best_score[0], -best_score[1], len(self.cache)))
+
+            if not improved:
+                return best, best_score
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='thresholds.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--labels', default=golden.LABELS, help='label file to score against')
+    parser.add_argument('--images', help='directory of the labelled images (default: next to the labels)')
+    args = parser.parse_args()
+
+    labels = golden.load_labels(args.labels)
+    if labels is None:
+        parser.error('no labels at %s' % args.labels)
+
+    images = args.images or os.path.dirname(os.path.abspath(args.labels))
+
+    # start from the current settings
+    processor = golden.make_processor()
+    start = [int(getattr(processor, name)) for name in NAMES]
+
+    begin = time.monotonic()
+    with ProcessPoolExecutor(args.workers) as executor:
+        tuner = Tuner(executor, functools.partial(score, args.labels, images))
+        best, (matched, error) = tuner.tune(start)
+
+    with open(args.output, 'w') as fp:
+        json.dump(dict(zip(NAMES, best)), fp, indent=4, sort_keys=True)
+
+    print('%d of %d images matched in %.0f s, wrote %s' %
+          (matched, len(labels['frames']), time.monotonic() - begin, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,65 +2,169 @@
 To run this without the robot (must have cscore installed on Linux):
 
     python3 -m cscore vision.py:main
+
+To run it on recorded frames (a directory of images, a video or a
+recording made with /camera/control/record) instead of a camera:
+
+    python3 vision.py path/to/frames [--realtime]
 """
 
+import argparse
+import logging
+import multiprocessing
+import os.path
+import sys
+import threading
+import time
+
 import cscore as cs
 import cv2
 import numpy as np
 
+import demand
+from clock_sync import ClockSync
+from frame_buffer import LatestFrame
 from image_processor import ImageProcessor
+from recorder import FrameRecorder
+from replay import ReplaySource
+from stats import StatsPublisher
+from workers import (CameraControl, FrameRing, RingSink, Supervisor,
+                     light_ring_worker, piston_cam_worker,
+                     setup_light_ring_cam, setup_piston_cam)
 
 from networktables import NetworkTable
 from networktables.util import ntproperty
 
+logger = logging.getLogger('vision')
+
 
 def main():
     vision = VictisVision()
     vision.process()
 
 
+def replay_main():
+    parser = argparse.ArgumentParser(description='Runs the vision loop on recorded frames')
+    parser.add_argument('path', help='directory of images, video file or recording')
+    parser.add_argument('--realtime', action='store_true',
+                        help='keep the original frame timing instead of running flat out')
+    args = parser.parse_args()
+
+    vision = VictisVision(replay=ReplaySource(args.path, args.realtime))
+
+    start = time.monotonic()
+    frames = vision.process()
+    elapsed = time.monotonic() - start
+
+    print('%d frames in %.2f s, %.1f fps' % (frames, elapsed, frames / elapsed))
+
+
 class VictisVision:
     STREAM_CV = False
+
+    # Run each camera in its own process
+    MULTIPROCESS = True
+
+    # Decode light ring cam frames at 1/2 or 1/4 size; the target is big
+    # enough to find at lower resolution
+    DECODE_SCALE = 1
+
+    # How long the idle loop sleeps if it never hears about vision_demand
+    IDLE_TIMEOUT = 1.0
+
+    # Frames per second processed when only target presence is wanted
+    KEEPALIVE_RATE = 2.0
+
+    # How often /camera/stats is published
+    STATS_INTERVAL = 1.0
+
+    # Raw light ring cam frames are recorded here while record is on
+    RECORD_PATH = '/home/lvuser/vision.rec'
+    RECORD_SLOTS = 300
+
+    # Written by tune.py, applied on top of the defaults at startup
+    THRESHOLDS_PATH = '/home/lvuser/thresholds.json'
     
     secondary_cam = ntproperty('/camera/control/secondary_cam', False)
 
-    cv_enabled = ntproperty('/camera/control/cv_enabled', False)
+    vision_demand = ntproperty('/camera/control/vision_demand', demand.OFF)
     dark_exposure = ntproperty('/camera/control/dark_exposure', 3)
 
+    record = ntproperty('/camera/control/record', False)
+
     test = ntproperty('/camera/control/test', 0)
 
-    def __init__(self):
+    def __init__(self, replay=None):
         self.nt = NetworkTable.getTable('/camera')
+
+        # A ReplaySource stands in for the light ring cam when given
+        self.replay = replay
+        self.has_cv_cam = self.secondary_cam or replay is not None
+
+        # recordings are replayed at the size they were taken
+        scale = 1 if replay is not None else self.DECODE_SCALE
+        shape = (240 // scale, 320 // scale, 3)
+
+        # Wakes the idle loop as soon as vision_demand changes
+        self.control_changed = threading.Event()
+        self.control = NetworkTable.getTable('/camera/control')
+        self.control.addTableListener(self._on_control, True, 'vision_demand')
+
+        # CPU and wall clock seconds spent in each mode
+        self.mode = None
+        self.cpu_time = {'idle': 0.0, 'active': 0.0}
+        self.wall_time = {'idle': 0.0, 'active': 0.0}
+
+        # Counters only ever go up; the stats thread publishes them
+        self.processed = 0
+        self.grab_timeouts = 0
+        self.stats = StatsPublisher(NetworkTable.getTable('/camera/stats'), self.STATS_INTERVAL)
         
         #Cameras
-        self.piston_cam = cs.UsbCamera('Piston Cam', 0)
-        self.piston_cam.setVideoMode(cs.VideoMode.PixelFormat.kMJPEG, 160, 120, 35) #160 vs. 120
-        
-        self.piston_cam.setExposureAuto()
-        self.piston_cam.getProperty('backlight_compensation').set(5)
-        
-        #self.piston_cam.setExposureManual(35)
-        #self.piston_cam.setBrightness(65)
-        #test = self.piston_cam.getProperty("exposure_absolute")
-        #print(self.piston_cam.getProperty("exposure_absolute"))
+        if replay is not None:
+            # no cameras at all when replaying
+            self.vision_demand = demand.ALIGN
+        elif self.MULTIPROCESS:
+            # spawn, so the camera processes start without our cscore/NT state
+            ctx = multiprocessing.get_context('spawn')
+            self.supervisor = Supervisor(ctx)
+            self.stats.add_counter('worker_restarts', lambda: self.supervisor.restarts)
+            self.supervisor.start_worker('piston cam', piston_cam_worker)
+        else:
+            self.piston_cam, self.piston_server = setup_piston_cam()
         
-        
-        self.piston_server = cs.MjpegServer('httpserver', 1181)
-        self.piston_server.setSource(self.piston_cam)
-        
-        if self.secondary_cam:
-            self.light_ring_cam = cs.UsbCamera('Light Ring Cam', 0)
-            self.light_ring_cam.setVideoMode(cs.VideoMode.PixelFormat.kMJPEG, 320, 240, 20)
-            
-            # This only seems to affect automatic exposure mode
-            # -> higher value means it lets more light in when facing a big light
-            self.light_ring_cam.getProperty('backlight_compensation').set(5)
+        if self.has_cv_cam:
+            if replay is not None:
+                self.light_ring_cam = self.cvsink = replay
+                self.capturing = threading.Event()
+            elif self.MULTIPROCESS:
+                self.frame_ring = FrameRing(ctx, shape)
+                self.light_ring_cam = CameraControl(ctx)
+                self.supervisor.start_worker('light ring cam', light_ring_worker, self.frame_ring, self.light_ring_cam, scale)
+
+                self.cvsink = RingSink(self.frame_ring)
+                self.stats.add_counter('ring_dropped_frames', lambda: self.cvsink.dropped)
+
+                # Set while frames are wanted from the light ring cam
+                self.capturing = self.light_ring_cam.active
+            else:
+                self.light_ring_cam, self.cvsink = setup_light_ring_cam(scale)
+                self.capturing = threading.Event()
             
             #Image Processing
-            self.cvsink = cs.CvSink('cvsink')
-            self.cvsink.setSource(self.light_ring_cam)
+            # the scale goes in before the first config snapshot is taken
+            self.processor = ImageProcessor(decode_scale=scale)
+            self.processor.render = False
+
+            if os.path.exists(self.THRESHOLDS_PATH):
+                logger.info('Loading thresholds from %s', self.THRESHOLDS_PATH)
+                self.processor.load_config(self.THRESHOLDS_PATH)
+
+            # target timestamps are published in robot time
+            self.clock = ClockSync()
+            self.processor.clock = self.clock
             
-            self.cvsource = cs.CvSource('cvsource', cs.VideoMode.PixelFormat.kMJPEG, 320, 240, 20)
+            self.cvsource = cs.CvSource('cvsource', cs.VideoMode.PixelFormat.kMJPEG, shape[1], shape[0], 20)
             
             #Streaming Servers
             
@@ -72,41 +176,221 @@ class VictisVision:
             if self.STREAM_CV:
                 self.cv_stream = cs.MjpegServer('cv stream', 1183)
                 self.cv_stream.setSource(self.cvsource)
+
+                # The server enables its sink while a client is connected
+                self.stream_listener = cs.VideoListener(self._on_stream_event,
+                                                        cs.VideoEvent.Kind.kSinkEnabled | cs.VideoEvent.Kind.kSinkDisabled,
+                                                        True)
             
-            #Blank mat
-            self.img = np.zeros(shape=(320, 240, 3), dtype=np.uint8)
-            
-            self.processor = ImageProcessor()
+            # Pipeline stages hand frames to each other through these, so
+            # capture, processing and streaming never wait on each other
+            self.frames = LatestFrame(shape, np.uint8,
+                                      lossless=replay is not None and not replay.realtime)
+            self.stream_frames = LatestFrame(shape, np.uint8)
+
+            self.stats.add_counter('fps', lambda: self.processed, rate=True)
+            self.stats.add_counter('grab_timeouts', lambda: self.grab_timeouts)
+            self.stats.add_counter('dropped_frames', lambda: self.frames.dropped)
+            self.stats.add_counter('skipped_frames', lambda: self.processor.skipped_frames)
+            self.stats.add_times(self.processor.times)
+            self.stats.add_counter('clock_rtt_ms', lambda: (self.clock.rtt or 0.0) * 1000.0)
+
+            # created the first time recording is turned on
+            self.recorder = None
     
+    def _on_control(self, source, key, value, isNew):
+        self.control_changed.set()
+
+    def _on_stream_event(self, event):
+        if event.name == self.cv_stream.getName():
+            # Don't spend time drawing overlays that nobody is watching
+            self.processor.render = event.kind == cs.VideoEvent.Kind.kSinkEnabled
+
+    def _account_cpu(self, mode):
+        """
+        Charges the time since the last call to the mode we were in and
+        publishes its CPU load, then switches to `mode`.
+        """
+        cpu = time.process_time()
+        wall = time.monotonic()
+
+        if self.mode is not None:
+            self.cpu_time[self.mode] += cpu - self.cpu_mark
+            self.wall_time[self.mode] += wall - self.wall_mark
+
+            load = self.cpu_time[self.mode] / max(self.wall_time[self.mode], 1e-6)
+            self.nt.putNumber('stats/%s_cpu_load' % self.mode, load)
+
+        self.mode = mode
+        self.cpu_mark = cpu
+        self.wall_mark = wall
+
+    def idle(self, timeout=None):
+        """
+        Blocks until vision_demand changes (or the timeout passes) instead of
+        spinning.
+        """
+        self.control_changed.wait(self.IDLE_TIMEOUT if timeout is None else timeout)
+        self.control_changed.clear()
+        self._account_cpu('idle')
+
+    def keep_alive(self, started):
+        """
+        Holds off until the next keep-alive frame is due, without grabbing
+        frames in the meantime. Returns early if the demand changes.
+
+        :param started: time.monotonic() when the last frame was taken
+        """
+        delay = started + 1.0 / self.KEEPALIVE_RATE - time.monotonic()
+        if delay <= 0:
+            return
+
+        self.capturing.clear()
+        self.control_changed.wait(delay)
+        self.control_changed.clear()
+
+        # the next frame has to be taken after this point
+        self.frames.discard()
+        self.capturing.set()
+
+    def capture(self):
+        """
+        Capture stage: grabs frames as fast as the camera delivers them.
+        """
+        while True:
+            self.capturing.wait()
+
+            img = self.frames.acquire()
+            ts, img = self.cvsink.grabFrame(img)
+
+            if ts == 0:
+                self.frames.release(img)
+
+                if self.replay is not None and self.replay.finished:
+                    self.frames.close()
+                    return
+
+                self.grab_timeouts += 1
+                self.cvsource.notifyError(self.cvsink.getError())
+                continue
+
+            if self.record:
+                self.record_frame(img, ts)
+
+            self.frames.publish(img, ts)
+
+    def record_frame(self, img, ts):
+        """
+        Records a raw frame. A recording that fails (flash full, bad path)
+        turns recording off rather than taking the capture thread down.
+        """
+        try:
+            if self.recorder is None:
+                self.recorder = FrameRecorder(self.RECORD_PATH, img.shape, self.RECORD_SLOTS)
+            self.recorder.record(img, ts)
+        except OSError:
+            logger.exception('Recording to %s failed, turning recording off', self.RECORD_PATH)
+            self.record = False
+
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+    def stream(self):
+        """
+        Stream stage: hands processed frames to the cv stream.
+        """
+        while True:
+            img, _ = self.stream_frames.take()
+            self.cvsource.putFrame(img)
+            self.stream_frames.release(img)
+
     def process(self):
+        """
+        Runs the vision loop. Only returns at the end of a replay.
+
+        :return: number of frames processed
+        """
 
         exposure = None
+        active = None
+
+        self.stats.start()
+
+        if not self.has_cv_cam:
+            # The piston cam is served entirely by cscore, nothing to do here
+            while True:
+                self.idle()
+
+        self.clock.start()
+
+        threading.Thread(target=self.capture, daemon=True).start()
+        if self.STREAM_CV:
+            threading.Thread(target=self.stream, daemon=True).start()
 
         while True:
-            if self.secondary_cam:
-                if self.cv_enabled:
-                    
-                    if exposure != 'dark':
+            level = int(self.vision_demand)
+
+            if level != demand.OFF:
+
+                # Presence only needs to notice a target, so keep auto
+                # exposure for the drivers and only go dark to align
+                wanted = 'dark' if level == demand.ALIGN else 'auto'
+
+                if not active:
+                    self._account_cpu('active')
+                    self.frames.discard()
+                    self.capturing.set()
+                    active = True
+
+                if exposure != wanted:
+                    if wanted == 'dark':
                         self.light_ring_cam.setExposureManual(int(self.dark_exposure))
-                        exposure = 'dark'
-                    
-                    time, self.img = self.cvsink.grabFrame(self.img)
-            
-                    if time == 0:
-                        self.cvsource.notifyError(self.cvsink.getError())
-                        continue
-                    
-                    self.img = self.processor.process_frame(self.img, time) 
-                else:
-                    if exposure != 'auto':
+                    else:
                         self.light_ring_cam.setExposureAuto()
-                        exposure = 'auto'
-                    
-                    self.nt.putBoolean('processor/gear_target_present', False)
-                    
-                if self.STREAM_CV:
-                    self.cvsource.putFrame(self.img)
+                    exposure = wanted
+
+                    # don't process whatever was left over from last time
+                    self.frames.discard()
+
+                started = time.monotonic()
+
+                item = self.frames.take(timeout=1.0)
+                if item is None:
+                    if self.frames.closed:
+                        return self.processed
+                    continue
+
+                img, ts = item
+                out = self.processor.process_frame(img, ts)
+                self.frames.release(img)
+                self.processed += 1
+
+                if self.processor.render:
+                    buf = self.stream_frames.acquire()
+                    np.copyto(buf, out)
+                    self.stream_frames.publish(buf, ts)
+
+                if level == demand.PRESENCE:
+                    self.keep_alive(started)
+            else:
+                if active is not False:
+                    self._account_cpu('idle')
+
+                    self.capturing.clear()
+                    self.light_ring_cam.setExposureAuto()
+                    exposure = 'auto'
+                    active = False
+
+                    # Only needs to be said once, not on every idle wakeup
+                    self.processor.publish_target(0, False)
+                    self.processor.publish_target(0, False, name='boiler_target')
+                
+                self.idle()
 
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        replay_main()
+    else:
+        main()
@@ -0,0 +1,322 @@
+"""
+Runs each camera in its own process, so that one camera stalling (or the
+GIL being busy with image processing) can't hold up the other.
+
+Frames from the light ring cam reach the vision process through a
+:class:`FrameRing` in shared memory instead of being pickled.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import urllib.request
+
+import cscore as cs
+import cv2
+import numpy as np
+
+logger = logging.getLogger('vision.workers')
+
+
+def setup_piston_cam():
+    camera = cs.UsbCamera('Piston Cam', 0)
+    camera.setVideoMode(cs.VideoMode.PixelFormat.kMJPEG, 160, 120, 35) #160 vs. 120
+
+    camera.setExposureAuto()
+    camera.getProperty('backlight_compensation').set(5)
+
+    #camera.setExposureManual(35)
+    #camera.setBrightness(65)
+
+    server = cs.MjpegServer('httpserver', 1181)
+    server.setSource(camera)
+
+    return camera, server
+
+
+def setup_light_ring_cam(decode_scale=1):
+    """
+    :param decode_scale: 1, 2 or 4; above 1 frames are decoded at that
+                         fraction of the camera resolution
+    """
+    camera = cs.UsbCamera('Light Ring Cam', 0)
+    camera.setVideoMode(cs.VideoMode.PixelFormat.kMJPEG, 320, 240, 20)
+
+    # This only seems to affect automatic exposure mode
+    # -> higher value means it lets more light in when facing a big light
+    camera.getProperty('backlight_compensation').set(5)
+
+    if decode_scale == 1:
+        sink = cs.CvSink('cvsink')
+        sink.setSource(camera)
+        return camera, sink
+
+    # CvSink always decodes at full size, so take the JPEGs from a stream
+    # and decode them ourselves
+    server = cs.MjpegServer('light ring server', 1182)
+    server.setSource(camera)
+
+    sink = MjpegSink('http://localhost:1182/?action=stream', decode_scale)
+
+    return camera, sink
+
+
+class MjpegSink:
+    """
+    Reads an MJPEG HTTP stream and decodes each JPEG at a reduced scale,
+    which is much cheaper than decoding it at full size and resizing.
+    Same interface as cscore's CvSink.
+    """
+
+    FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+    }
+
+    def __init__(self, url, scale=2, timeout=1.0):
+        self.url = url
+        self.flags = self.FLAGS[scale]
+        self.timeout = timeout
+
+        self.stream = None
+        self.error = ''
+
+    def _read_jpeg(self):
+        """
+        :return: the bytes of the next JPEG in the stream
+        """
+        if self.stream is None:
+            self.stream = urllib.request.urlopen(self.url, timeout=self.timeout)
+
+        # part headers, up to the blank line
+        length = None
+        while True:
+            line = self.stream.readline()
+            if not line:
+                raise OSError('stream closed')
+
+            line = line.strip()
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+            elif not line and length is not None:
+                break
+
+        return self.stream.read(length)
+
+    def grabFrame(self, img):
+        try:
+            data = self._read_jpeg()
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+            self.stream = None
+            return 0, img
+
+        # cscore stamps frames in microseconds
+        ts = time.monotonic() * 1e6
+
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), self.flags)
+        if frame is None:
+            self.error = 'could not decode frame'
+            return 0, img
+
+        if img is None or img.shape != frame.shape:
+            return ts, frame
+
+        np.copyto(img, frame)
+        return ts, img
+
+    def getError(self):
+        return self.error
+
+
+class FrameRing:
+    """
+    Ring of frame slots in shared memory, written by one process and read
+    by another. Writing a frame is one copy into its slot; the reader
+    always gets the newest frame.
+    """
+
+    def __init__(self, ctx, shape, slots=4):
+        self.shape = tuple(shape)
+        self.slots = slots
+
+        self.data = ctx.RawArray('B', slots * int(np.prod(shape)))
+        self.stamps = ctx.RawArray('d', slots)
+        self.written = ctx.RawValue('q', 0)
+        self.cond = ctx.Condition()
+
+        self._frames = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    @property
+    def frames(self):
+        # numpy views can't be sent to another process, so each side makes its own
+        if self._frames is None:
+            self._frames = np.frombuffer(self.data, dtype=np.uint8).reshape((self.slots,) + self.shape)
+        return self._frames
+
+    def write(self, img, ts):
+        n = self.written.value
+        i = n % self.slots
+
+        self.frames[i][...] = img
+        self.stamps[i] = ts
+
+        with self.cond:
+            self.written.value = n + 1
+            self.cond.notify_all()
+
+    def read(self, out, last, timeout):
+        """
+        Copies the newest frame written after frame number `last` into `out`.
+
+        :return: (timestamp, frame number), or (0, last) on timeout
+        """
+        with self.cond:
+            if self.written.value <= last and not self.cond.wait_for(lambda: self.written.value > last, timeout):
+                return 0, last
+
+        while True:
+            n = self.written.value
+            i = (n - 1) % self.slots
+
+            ts = self.stamps[i]
+            np.copyto(out, self.frames[i])
+
+            # the writer may have lapped us while copying
+            if self.written.value - n < self.slots - 1:
+                return ts, n
+
+
+class RingSink:
+    """
+    Reads frames from a :class:`FrameRing` with the same interface as
+    cscore's CvSink, so the capture stage can't tell the difference.
+    """
+
+    def __init__(self, ring, timeout=0.5):
+        self.ring = ring
+        self.timeout = timeout
+        self.last = 0
+        self.dropped = 0
+
+    def grabFrame(self, img):
+        if img is None or img.shape != self.ring.shape:
+            img = np.empty(self.ring.shape, dtype=np.uint8)
+
+        ts, n = self.ring.read(img, self.last, self.timeout)
+        if ts != 0:
+            self.dropped += n - self.last - 1
+            self.last = n
+
+        return ts, img
+
+    def getError(self):
+        return 'timed out waiting for the light ring cam process'
+
+
+class CameraControl:
+    """
+    Stands in for the light ring UsbCamera in the vision process; the
+    camera process picks up the settings from shared memory.
+    """
+
+    AUTO = -1
+
+    def __init__(self, ctx):
+        self.exposure = ctx.RawValue('i', self.AUTO)
+        self.active = ctx.Event()
+
+    def setExposureAuto(self):
+        self.exposure.value = self.AUTO
+
+    def setExposureManual(self, value):
+        self.exposure.value = value
+
+
+def piston_cam_worker():
+    camera, server = setup_piston_cam()
+
+    # cscore serves the stream on its own threads
+    while True:
+        time.sleep(60)
+
+
+def light_ring_worker(ring, control, decode_scale=1):
+    camera, sink = setup_light_ring_cam(decode_scale)
+
+    img = np.zeros(ring.shape, dtype=np.uint8)
+    exposure = None
+
+    while True:
+        if control.exposure.value != exposure:
+            exposure = control.exposure.value
+            if exposure == CameraControl.AUTO:
+                camera.setExposureAuto()
+            else:
+                camera.setExposureManual(exposure)
+
+        if not control.active.wait(0.5):
+            continue
+
+        ts, img = sink.grabFrame(img)
+        if ts == 0:
+            logger.warning('Light ring cam: %s', sink.getError())
+            continue
+
+        ring.write(img, ts)
+
+
+def _watch_parent(parent, interval):
+    # daemon=True only cleans up after a parent that exits normally. If the
+    # vision process is killed, this process gets reparented; exit then
+    # instead of holding on to the cameras and ports the next one needs.
+    while os.getppid() == parent:
+        time.sleep(interval)
+
+    logger.error('%s: vision process is gone, exiting', multiprocessing.current_process().name)
+    os._exit(1)
+
+
+def _run_worker(parent, interval, target, *args):
+    threading.Thread(target=_watch_parent, args=(parent, interval), name='parent watch', daemon=True).start()
+    target(*args)
+
+
+class Supervisor:
+    """
+    Starts the camera processes and restarts any that die. Each process
+    exits by itself within `interval` once the supervising process is gone.
+    """
+
+    def __init__(self, ctx, interval=1.0):
+        self.ctx = ctx
+        self.interval = interval
+        self.workers = {}
+        self.restarts = 0
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def start_worker(self, name, target, *args):
+        process = self.ctx.Process(target=_run_worker, args=(os.getpid(), self.interval, target) + args,
+                                   name=name, daemon=True)
+        process.start()
+
+        self.workers[name] = (process, target, args)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            for name, (process, target, args) in list(self.workers.items()):
+                if not process.is_alive():
+                    logger.error('%s exited with %s, restarting', name, process.exitcode)
+                    self.restarts += 1
+                    self.start_worker(name, target, *args)
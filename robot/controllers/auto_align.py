@@ -1,3 +1,5 @@
+import math
+
 import hal
 import wpilib
 
@@ -5,45 +7,60 @@ from magicbot import state, timed_state, StateMachine, tunable
 from networktables import NetworkTable
 from networktables.util import ntproperty
 
+from camera import demand, target_record
 from components.swervedrive import SwerveDrive
-from controllers.pos_controller import XPosController, YPosController
+from controllers.pos_controller import FCXPosController, FCYPosController
 from controllers.angle_controller import AngleController
 from controllers.position_history import PositionHistory
+from controllers.position_tracker import FCPositionTracker
 
 
 class AutoAlign(StateMachine):
     drive = SwerveDrive
 
-    x_ctrl = XPosController
-    y_ctrl = YPosController
+    fc_x_ctrl = FCXPosController
+    fc_y_ctrl = FCYPosController
     angle_ctrl = AngleController
 
     pos_history = PositionHistory
+    fc_tracker = FCPositionTracker
 
-    cv_enabled = ntproperty('/camera/control/cv_enabled', False)
+    vision_demand = ntproperty('/camera/control/vision_demand', demand.OFF)
 
     ideal_skew = tunable(-0.967)
     ideal_angle = tunable(-1.804)
 
+    # How far in front of the peg to stop, in feet
+    peg_standoff = tunable(1.0)
+
     def __init__(self):
         target = None
+        self.last_seq = None
 
         nt = NetworkTable.getTable('/camera')
         nt.addTableListener(self._on_target, True, 'target')
 
         self.aimed_at_angle = None
         self.aimed_at_x = None
+        self.aimed_at_y = None
 
     def _on_target(self, source, key, value, isNew):
-        self.target = value
+        # All fields of a record come from the same frame, see camera/target_record.py
+        if len(value) >= target_record.FIELDS and value[target_record.SEQ] != self.last_seq:
+            self.last_seq = value[target_record.SEQ]
+
+            if value[target_record.PRESENT] and not value[target_record.PARTIAL]:
+                self.target = value
 
     def _move_to_position(self):
         target = self.target
 
-        if target is not None and len(target) > 0:
-            target = target[:]
+        if target is not None:
+            angle = target[target_record.ANGLE]
 
-            angle, skew, capture_ts = target
+            # Without a synced clock we can't tell when the frame was taken,
+            # so the newest position is the best guess
+            capture_ts = target[target_record.TIMESTAMP] if target[target_record.SYNCED] else None
             history = self.pos_history.get_position(capture_ts)
 
             if history is not None:
@@ -51,6 +68,19 @@ class AutoAlign(StateMachine):
 
                 self.aimed_at_angle = r_angle + angle - self.ideal_angle
 
+                # The camera looks straight ahead, so its lateral offset is
+                # robot x and its distance robot y. The robot turns before
+                # driving there, so rotate them by the heading it had when
+                # the frame was taken into the field frame the fc tracker
+                # keeps, where the goal stays put while the robot turns.
+                if target[target_record.POSE]:
+                    lateral = target[target_record.LATERAL]
+                    forward = target[target_record.DISTANCE] - self.peg_standoff
+
+                    theta = math.radians(r_angle)
+                    self.aimed_at_x = r_x + lateral * math.cos(theta) + forward * math.sin(theta)
+                    self.aimed_at_y = r_y + forward * math.cos(theta) - lateral * math.sin(theta)
+
             self.target = None
 
         if self.aimed_at_angle is not None:
@@ -65,21 +95,39 @@ class AutoAlign(StateMachine):
     def inital_state(self):
         self.target = None
         self.aimed_at_angle = None
+        self.aimed_at_x = None
+        self.aimed_at_y = None
 
+        self.fc_tracker.enable()
         self.pos_history.enable()
 
-        self.cv_enabled = True
+        self.vision_demand = demand.ALIGN
 
         self.next_state('moving_to_position')
 
     @state
     def moving_to_position(self):
         if self._move_to_position():
-            self.next_state('done')
+            if self.aimed_at_y is not None:
+                self.next_state('driving_to_peg')
+            else:
+                self.next_state('done')
+
+    @state
+    def driving_to_peg(self):
+        # keeps refining the goal as new frames come in
+        self._move_to_position()
+
+        self.fc_x_ctrl.move_to(self.aimed_at_x)
+        self.fc_y_ctrl.move_to(self.aimed_at_y)
+
+        if self.fc_x_ctrl.is_at_location() and self.fc_y_ctrl.is_at_location():
+            self.done()
 
     def done(self):
         super().done()
 
         self.pos_history.disable()
+        self.fc_tracker.disable()
 
-        self.cv_enabled = False
+        self.vision_demand = demand.OFF
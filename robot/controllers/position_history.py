@@ -4,13 +4,18 @@ import time
 import threading
 
 from controllers.angle_controller import AngleController
+from controllers.pos_controller import FCXPosController, FCYPosController
 from components import swervedrive
 from collections import deque
+from networktables import NetworkTable
 
 
 class PositionHistory:
 
     angle_ctrl = AngleController
+    # field centric, so positions stay comparable while the robot turns
+    fc_x_ctrl = FCXPosController
+    fc_y_ctrl = FCYPosController
 
     def __init__(self):
         self.running = True
@@ -30,6 +35,11 @@ class PositionHistory:
             self.delay = time.sleep
             self.get_now = time.time
 
+        # Lets the vision process convert its timestamps to get_now() time,
+        # see camera/clock_sync.py
+        self.clock_nt = NetworkTable.getTable('/camera/clock')
+        self.clock_nt.addTableListener(self._on_ping, False, 'ping')
+
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
 
@@ -55,12 +65,28 @@ class PositionHistory:
             self.enabled = False
             self.last_ts = None
 
-    def get_position(self, ts):
-        if self.last_ts is not None:
-            with self.lock:
-                offset = round((self.last_ts - ts)/0.050)
-                if offset < len(self.buffer):
-                    return self.buffer[offset]
+    def _on_ping(self, source, key, value, isNew):
+        if len(value) >= 2:
+            self.clock_nt.putNumberArray('pong', [value[0], value[1], self.get_now()])
+            NetworkTable.flush()
+
+    def get_position(self, ts=None):
+        """
+        :param ts: a get_now() time, or None for the newest position
+        :return: (angle, x, y, time) recorded closest to ts, or None
+        """
+        with self.lock:
+            if self.last_ts is None:
+                return None
+
+            if ts is None:
+                return self.buffer[0]
+
+            # a timestamp slightly ahead of the last sample is the last sample,
+            # not (with a negative index) the oldest one
+            offset = max(round((self.last_ts - ts)/0.050), 0)
+            if offset < len(self.buffer):
+                return self.buffer[offset]
 
     def _run(self):
         while True:
@@ -74,8 +100,8 @@ class PositionHistory:
 
                 now = self.get_now()
                 angle = self.angle_ctrl.get_angle()
-                x = self.x_ctrl.get_position()
-                y = self.y_ctrl.get_position()
+                x = self.fc_x_ctrl.get_position()
+                y = self.fc_y_ctrl.get_position()
 
                 with self.lock:
                     if self.enabled:
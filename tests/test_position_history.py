@@ -0,0 +1,63 @@
+"""
+Checks which sample PositionHistory.get_position picks for a timestamp.
+The sampling thread isn't started, the buffer is filled by hand.
+"""
+
+import os.path
+import sys
+import threading
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('wpilib')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robot'))
+
+from controllers.position_history import PositionHistory  # noqa: E402
+
+
+def make_history(times):
+    """
+    :param times: sample times, oldest first, 50ms apart like _run takes them
+    """
+    history = SimpleNamespace(lock=threading.Lock(), last_ts=None, buffer=deque(maxlen=20))
+    for i, t in enumerate(times):
+        history.buffer.appendleft((0.0, float(i), 0.0, t))
+        history.last_ts = t
+    return history
+
+
+def get_position(history, ts=None):
+    return PositionHistory.get_position(history, ts)
+
+
+def test_no_samples():
+    history = make_history([])
+    assert get_position(history) is None
+    assert get_position(history, 1.0) is None
+
+
+def test_newest_when_no_timestamp():
+    history = make_history([1.0, 1.05, 1.1])
+    assert get_position(history) == (0.0, 2.0, 0.0, 1.1)
+
+
+def test_closest_sample():
+    history = make_history([1.0, 1.05, 1.1])
+    assert get_position(history, 1.1) == (0.0, 2.0, 0.0, 1.1)
+    assert get_position(history, 1.06) == (0.0, 1.0, 0.0, 1.05)
+    assert get_position(history, 1.0) == (0.0, 0.0, 0.0, 1.0)
+
+
+def test_slightly_ahead_is_newest():
+    # used to come out as a negative index, which picked the oldest sample
+    history = make_history([1.0, 1.05, 1.1])
+    assert get_position(history, 1.14) == (0.0, 2.0, 0.0, 1.1)
+    assert get_position(history, 5.0) == (0.0, 2.0, 0.0, 1.1)
+
+
+def test_older_than_buffer():
+    history = make_history([1.0, 1.05, 1.1])
+    assert get_position(history, 0.8) is None
@@ -0,0 +1,72 @@
+"""
+Round trips frames through robot/camera/recorder.py.
+"""
+
+import os.path
+import sys
+
+import numpy as np
+import pytest
+
+# the vision code uses flat imports, it runs from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robot', 'camera'))
+
+from recorder import FrameRecorder, read_ring_file  # noqa: E402
+
+SHAPE = (4, 6, 3)
+
+
+def make_frame(n):
+    return np.full(SHAPE, n, dtype=np.uint8)
+
+
+def record(path, count, slots):
+    recorder = FrameRecorder(str(path), SHAPE, slots=slots)
+    for n in range(count):
+        recorder.record(make_frame(n), 10.0 + n)
+    recorder.close()
+
+    return read_ring_file(str(path))
+
+
+def test_round_trip(tmpdir):
+    frames = record(tmpdir.join('ring.bin'), 3, slots=5)
+
+    assert [ts for ts, _ in frames] == [10.0, 11.0, 12.0]
+    for n, (_, img) in enumerate(frames):
+        assert img.shape == SHAPE
+        assert (img == n).all()
+
+
+def test_wraparound_keeps_newest(tmpdir):
+    frames = record(tmpdir.join('ring.bin'), 12, slots=5)
+
+    assert [ts for ts, _ in frames] == [17.0, 18.0, 19.0, 20.0, 21.0]
+    for (ts, img) in frames:
+        assert (img == int(ts) - 10).all()
+
+
+def test_wrong_shape_is_skipped(tmpdir):
+    path = tmpdir.join('ring.bin')
+    recorder = FrameRecorder(str(path), SHAPE, slots=5)
+    recorder.record(np.zeros((2, 2, 3), dtype=np.uint8), 1.0)
+    recorder.record(make_frame(7), 2.0)
+    recorder.close()
+
+    frames = read_ring_file(str(path))
+    assert len(frames) == 1
+    assert frames[0][0] == 2.0
+
+
+def test_not_a_recording(tmpdir):
+    path = tmpdir.join('junk.bin')
+    path.write_binary(b'\0' * 256)
+
+    with pytest.raises(ValueError):
+        read_ring_file(str(path))
+
+
+def test_bad_path_raises(tmpdir):
+    # vision.py turns recording off on OSError, so that's what has to come out
+    with pytest.raises(OSError):
+        FrameRecorder(str(tmpdir.join('missing', 'ring.bin')), SHAPE, slots=5)
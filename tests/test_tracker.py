@@ -0,0 +1,48 @@
+"""
+Extrapolating the gear target between full detections.
+"""
+
+import os.path
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+
+# the vision code uses flat imports, it runs from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robot', 'camera'))
+
+import target_record  # noqa: E402
+from image_processor import ImageProcessor  # noqa: E402
+from tracker import AlphaBetaTracker  # noqa: E402
+
+
+def test_predict_before_any_measurement():
+    assert AlphaBetaTracker().predict(1.0) is None
+
+
+def test_predict_constant_velocity():
+    tracker = AlphaBetaTracker(alpha=1.0, beta=1.0)
+    tracker.update([10.0, 0.0, 20.0, 0.0], 0.0)
+    tracker.update([12.0, 0.0, 20.0, 0.0], 1.0)
+
+    assert tracker.predict(2.0)[0] == pytest.approx(14.0)
+
+
+def test_no_extrapolation_without_a_measurement():
+    # confidence 0 passes a min_confidence of 0, but there's nothing to predict from
+    processor = ImageProcessor()
+    processor.render = False
+    processor.roi_enabled = False
+    processor.tracker_enabled = True
+    processor.tracker_min_confidence = 0
+    processor.refresh_config()
+
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    processor.process_frame(frame, 1.0)
+    processor.process_frame(frame, 2.0)
+
+    record = processor.records['target']
+    assert not record[target_record.PRESENT]
+    assert not record[target_record.EXTRAPOLATED]
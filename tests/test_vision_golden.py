@@ -0,0 +1,52 @@
+"""
+Runs ImageProcessor over the golden images in robot/camera/images and checks
+that both detection backends still publish the same targets. How fast it
+runs is only reported: baseline_ms was measured on one machine, so it
+can't fail the suite on another. See
+robot/camera/golden.py for the label format and how to update it.
+"""
+
+import os.path
+import sys
+import warnings
+
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+# the vision code uses flat imports, it runs from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robot', 'camera'))
+
+import golden  # noqa: E402
+
+LABELS = golden.load_labels()
+
+pytestmark = pytest.mark.skipif(LABELS is None, reason='no golden labels, run golden.py --update')
+
+
+@pytest.fixture(scope='module', params=golden.DETECTORS)
+def detector_processor(request):
+    return golden.make_processor(request.param)
+
+
+@pytest.fixture(scope='module')
+def processor():
+    return golden.make_processor()
+
+
+@pytest.mark.parametrize('label', LABELS['frames'] if LABELS else [], ids=lambda label: label['image'])
+def test_golden_target(detector_processor, label):
+    found = golden.detect(detector_processor, golden.load_image(label['image']))
+    assert golden.compare(label, found) == []
+
+
+def test_golden_speed(processor, record_property):
+    images = [golden.load_image(label['image']) for label in LABELS['frames']]
+    ms = golden.median_ms(processor, images)
+
+    record_property('median_ms', ms)
+    record_property('baseline_ms', LABELS['baseline_ms'])
+
+    if ms > LABELS['baseline_ms'] * golden.TIME_BUDGET:
+        warnings.warn('%.2f ms/frame, baseline %.2f ms/frame was measured on another machine '
+                      'or before a slowdown' % (ms, LABELS['baseline_ms']))